@@ -0,0 +1,316 @@
+"""Tiered storage for amaru_paty_conversations: compact old turns into archive segments.
+
+The request path only reads a session's newest HISTORY_LOAD_TURNS rows, so
+everything older can leave the hot table. `compact` keeps each session's newest
+--keep turns (never fewer than HISTORY_LOAD_TURNS) plus anything younger than
+--min-age-days. It moves older turns into gzip JSONL segments, one per session,
+month and run, and records each in amaru_paty_archive_segments.
+
+Each segment is written and read back, then indexed, and only then deleted from
+the hot table, by id. A run that stops part way finishes the delete next time,
+so every turn is always either hot or archived (or briefly both).
+
+`show` prints a session's archived turns. `restore` puts them back in the hot
+table and removes their segments. If they are still outside the hot window,
+the next compaction archives them again.
+
+Segments go to the Supabase Storage bucket ARCHIVE_BUCKET, or to a local
+directory with --archive-dir. Compaction works on the Supabase backend only;
+a local SQLite store (STORAGE_BACKEND=sqlite) has no hot-table cost to cut.
+
+    python archive.py compact --dry-run
+    python archive.py compact --keep 200 --min-age-days 30
+    python archive.py show --session abc > abc.jsonl
+    python archive.py restore --session abc --month 2025-11
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import main
+
+CONVERSATIONS_TABLE = "amaru_paty_conversations"
+SEGMENTS_TABLE = "amaru_paty_archive_segments"
+ARCHIVE_COLUMNS = "id,session_id,user_id,role,content,model_used,timestamp"
+
+ARCHIVE_BUCKET = os.getenv("ARCHIVE_BUCKET", "amaru-archive")
+ARCHIVE_KEEP_TURNS = int(os.getenv("ARCHIVE_KEEP_TURNS", 200))
+ARCHIVE_MIN_AGE_DAYS = float(os.getenv("ARCHIVE_MIN_AGE_DAYS", 30))
+ARCHIVE_SEGMENT_TURNS = int(os.getenv("ARCHIVE_SEGMENT_TURNS", 5000))
+
+# Ids per DELETE ... WHERE id IN (...), so the request URL stays short
+DELETE_CHUNK = 200
+
+
+class SegmentStore:
+    """Archive objects in a Supabase Storage bucket, or a local directory"""
+
+    def __init__(self, archive_dir: str = None):
+        self.archive_dir = archive_dir
+
+    def put(self, key: str, data: bytes):
+        if self.archive_dir:
+            path = os.path.join(self.archive_dir, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        else:
+            main.get_supabase().storage.from_(ARCHIVE_BUCKET).upload(
+                key, data, {"content-type": "application/gzip", "upsert": "true"}
+            )
+
+    def get(self, key: str) -> bytes:
+        if self.archive_dir:
+            with open(os.path.join(self.archive_dir, key), "rb") as f:
+                return f.read()
+        return main.get_supabase().storage.from_(ARCHIVE_BUCKET).download(key)
+
+    def delete(self, key: str):
+        if self.archive_dir:
+            try:
+                os.remove(os.path.join(self.archive_dir, key))
+            except FileNotFoundError:
+                pass
+        else:
+            main.get_supabase().storage.from_(ARCHIVE_BUCKET).remove([key])
+
+
+def encode_segment(rows: list[dict]) -> tuple[bytes, int]:
+    raw = "".join(json.dumps(row, ensure_ascii=False, sort_keys=True) + "\n" for row in rows).encode()
+    return gzip.compress(raw, compresslevel=9, mtime=0), len(raw)
+
+
+def decode_segment(data: bytes) -> list[dict]:
+    return [json.loads(line) for line in gzip.decompress(data).decode().splitlines() if line]
+
+
+def segment_key(session_id: str, month: str, rows: list[dict], digest: str) -> str:
+    first = main._timestamp_key(rows[0]["timestamp"]).strftime("%Y%m%dT%H%M%S%f")
+    return f"{quote(session_id, safe='')}/{month}/{first}-{digest[:12]}.jsonl.gz"
+
+
+def iter_sessions(cutoff: str, sessions: list[str] = None):
+    """Sessions with turns older than cutoff, one index probe per session (keyset on session_id)"""
+    if sessions:
+        yield from sessions
+        return
+    db = main.get_supabase()
+    last = None
+    while True:
+        query = db.table(CONVERSATIONS_TABLE).select("session_id").lt("timestamp", cutoff)
+        if last is not None:
+            query = query.gt("session_id", last)
+        rows = query.order("session_id").limit(1).execute().data
+        if not rows:
+            return
+        last = rows[0]["session_id"]
+        yield last
+
+
+def archive_boundary(session_id: str, keep: int, cutoff: str) -> str | None:
+    """Turns older than this are archived: outside the newest `keep` and older than cutoff"""
+    rows = main.get_supabase().table(CONVERSATIONS_TABLE)\
+        .select("timestamp")\
+        .eq("session_id", session_id)\
+        .order("timestamp", desc=True)\
+        .range(keep - 1, keep - 1)\
+        .execute().data
+    if not rows:
+        return None
+    oldest_kept = rows[0]["timestamp"]
+    return oldest_kept if main._timestamp_key(oldest_kept) < main._timestamp_key(cutoff) else cutoff
+
+
+def iter_archivable(session_id: str, boundary: str, page_size: int = 1000):
+    """A session's rows older than boundary, oldest first, paging by timestamp"""
+    db = main.get_supabase()
+    after = None
+    while True:
+        query = db.table(CONVERSATIONS_TABLE).select(ARCHIVE_COLUMNS)\
+            .eq("session_id", session_id)\
+            .lt("timestamp", boundary)
+        if after is not None:
+            query = query.gt("timestamp", after)
+        rows = query.order("timestamp").limit(page_size).execute().data or []
+        full = len(rows) == page_size
+        if full:
+            # Hold back rows sharing the last timestamp, so the next page's gt does not skip any
+            last = rows[-1]["timestamp"]
+            rows = [row for row in rows if row["timestamp"] != last] or rows
+        yield from rows
+        if not full:
+            return
+        after = rows[-1]["timestamp"]
+
+
+def delete_hot_rows(ids: list[int]):
+    db = main.get_supabase()
+    for start in range(0, len(ids), DELETE_CHUNK):
+        db.table(CONVERSATIONS_TABLE).delete().in_("id", ids[start:start + DELETE_CHUNK]).execute()
+
+
+def finish_interrupted(session_id: str, store: SegmentStore) -> int:
+    """Delete the hot rows of segments indexed by a run that stopped before deleting them"""
+    db = main.get_supabase()
+    segments = db.table(SEGMENTS_TABLE).select("object_key")\
+        .eq("session_id", session_id).eq("hot_deleted", False).execute().data or []
+    deleted = 0
+    for segment in segments:
+        ids = [row["id"] for row in decode_segment(store.get(segment["object_key"]))]
+        delete_hot_rows(ids)
+        db.table(SEGMENTS_TABLE).update({"hot_deleted": True}).eq("object_key", segment["object_key"]).execute()
+        deleted += len(ids)
+    return deleted
+
+
+def write_segment(session_id: str, month: str, rows: list[dict], store: SegmentStore) -> dict:
+    data, raw_bytes = encode_segment(rows)
+    digest = hashlib.sha256(data).hexdigest()
+    key = segment_key(session_id, month, rows, digest)
+    store.put(key, data)
+    if hashlib.sha256(store.get(key)).hexdigest() != digest:
+        raise RuntimeError(f"archive segment {key} did not read back intact")
+
+    segment = {
+        "object_key": key,
+        "session_id": session_id,
+        "month": month,
+        "first_timestamp": rows[0]["timestamp"],
+        "last_timestamp": rows[-1]["timestamp"],
+        "turns": len(rows),
+        "bytes": len(data),
+        "raw_bytes": raw_bytes,
+        "sha256": digest,
+        "hot_deleted": False,
+    }
+    db = main.get_supabase()
+    db.table(SEGMENTS_TABLE).upsert(segment, on_conflict="object_key").execute()
+    delete_hot_rows([row["id"] for row in rows])
+    db.table(SEGMENTS_TABLE).update({"hot_deleted": True}).eq("object_key", key).execute()
+    return segment
+
+
+def compact_session(session_id: str, keep: int, cutoff: str, store: SegmentStore, dry_run: bool) -> dict:
+    result = {"turns": 0, "segments": 0, "bytes": 0, "raw_bytes": 0, "resumed": 0}
+    if not dry_run:
+        result["resumed"] = finish_interrupted(session_id, store)
+    boundary = archive_boundary(session_id, keep, cutoff)
+    if boundary is None:
+        return result
+
+    pending: list[dict] = []
+
+    def flush():
+        if not pending:
+            return
+        result["turns"] += len(pending)
+        result["segments"] += 1
+        if not dry_run:
+            segment = write_segment(session_id, pending[0]["timestamp"][:7], pending, store)
+            result["bytes"] += segment["bytes"]
+            result["raw_bytes"] += segment["raw_bytes"]
+        pending.clear()
+
+    for row in iter_archivable(session_id, boundary):
+        if pending and (row["timestamp"][:7] != pending[0]["timestamp"][:7] or len(pending) >= ARCHIVE_SEGMENT_TURNS):
+            flush()
+        pending.append(row)
+    flush()
+    return result
+
+
+def compact(args):
+    store = SegmentStore(args.archive_dir)
+    keep = max(args.keep, main.HISTORY_LOAD_TURNS)
+    cutoff = (datetime.utcnow() - timedelta(days=args.min_age_days)).isoformat()
+    totals = {"sessions_scanned": 0, "sessions_compacted": 0, "turns": 0, "segments": 0,
+              "bytes": 0, "raw_bytes": 0, "resumed": 0}
+    started = time.perf_counter()
+    for session_id in iter_sessions(cutoff, args.session):
+        totals["sessions_scanned"] += 1
+        try:
+            result = compact_session(session_id, keep, cutoff, store, args.dry_run)
+        except Exception as e:
+            print(f"Error compacting session {session_id}: {e}", file=sys.stderr)
+            continue
+        if result["turns"]:
+            totals["sessions_compacted"] += 1
+        for name, value in result.items():
+            totals[name] += value
+    totals["keep"] = keep
+    totals["cutoff"] = cutoff
+    totals["dry_run"] = args.dry_run
+    totals["elapsed_s"] = round(time.perf_counter() - started, 2)
+    if totals["bytes"]:
+        totals["compression_ratio"] = round(totals["raw_bytes"] / totals["bytes"], 2)
+    print(json.dumps(totals))
+
+
+def list_segments(session_id: str, month: str = None) -> list[dict]:
+    query = main.get_supabase().table(SEGMENTS_TABLE).select("*").eq("session_id", session_id)
+    if month:
+        query = query.eq("month", month)
+    return query.order("first_timestamp").execute().data or []
+
+
+def iter_archived_turns(session_id: str, store: SegmentStore, month: str = None):
+    """Archived turns of a session, oldest first"""
+    for segment in list_segments(session_id, month):
+        yield from decode_segment(store.get(segment["object_key"]))
+
+
+def show(args):
+    store = SegmentStore(args.archive_dir)
+    for session_id in args.session:
+        for row in iter_archived_turns(session_id, store, args.month):
+            print(json.dumps(row, ensure_ascii=False))
+
+
+def restore(args):
+    store = SegmentStore(args.archive_dir)
+    db = main.get_supabase()
+    restored = 0
+    for session_id in args.session:
+        for segment in list_segments(session_id, args.month):
+            rows = decode_segment(store.get(segment["object_key"]))
+            # Original ids are kept, so restoring a segment twice cannot duplicate turns
+            for start in range(0, len(rows), main.WRITE_BATCH_SIZE):
+                db.table(CONVERSATIONS_TABLE).upsert(rows[start:start + main.WRITE_BATCH_SIZE], on_conflict="id").execute()
+            db.table(SEGMENTS_TABLE).delete().eq("object_key", segment["object_key"]).execute()
+            store.delete(segment["object_key"])
+            restored += len(rows)
+            print(f"restored {segment['object_key']} ({len(rows)} turns)")
+    print(json.dumps({"turns_restored": restored}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact old conversation turns into archive segments")
+    parser.add_argument("--archive-dir", help="store segments in this directory instead of the Supabase Storage bucket")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = commands.add_parser("compact", help="move turns outside the hot window into archive segments")
+    compact_parser.add_argument("--keep", type=int, default=ARCHIVE_KEEP_TURNS, help="newest turns kept hot per session")
+    compact_parser.add_argument("--min-age-days", type=float, default=ARCHIVE_MIN_AGE_DAYS,
+                                help="turns younger than this always stay hot")
+    compact_parser.add_argument("--session", action="append", help="only compact this session; repeatable")
+    compact_parser.add_argument("--dry-run", action="store_true", help="report what would be archived")
+    compact_parser.set_defaults(run=compact)
+
+    for name, run, text in (("show", show, "print archived turns as JSONL"),
+                            ("restore", restore, "move archived turns back into the hot table")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("--session", action="append", required=True, help="repeatable")
+        command.add_argument("--month", help="only segments of this month (YYYY-MM)")
+        command.set_defaults(run=run)
+
+    args = parser.parse_args()
+    if main.STORAGE_BACKEND != "supabase":
+        sys.exit("archive.py works on the Supabase backend only (STORAGE_BACKEND=supabase)")
+    args.run(args)
@@ -0,0 +1,181 @@
+"""Stand-in for the Anthropic Messages API with configurable latency and errors.
+
+Point the agent at it with ANTHROPIC_URL=http://127.0.0.1:<port>. Supports
+plain and streamed (SSE) POST /v1/messages, and the Message Batches endpoints
+(create, poll, results) used by replay.py. Latency is log-normal around the
+given medians; a fraction of calls can fail with 429/529 and a retry-after.
+Prompt caching is emulated: a system prompt seen before is reported as cache
+reads in the usage block.
+
+    python bench/fake_anthropic.py --port 8787 --ttft-ms 400 --token-ms 15 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+WORDS = ("Paty", "claro", "vamos", "paso", "a", "paso", "con", "calma", "y", "estrategia", "hoy", "mañana")
+
+
+def _lognormal(median_ms: float, sigma: float) -> float:
+    if median_ms <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(median_ms), sigma) / 1000
+
+
+def _text_of(content) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def create_app(ttft_ms: float = 400.0, token_ms: float = 15.0, sigma: float = 0.4,
+               min_tokens: int = 40, max_tokens: int = 250,
+               error_rate: float = 0.0, error_status: int = 529, retry_after: float = 1.0) -> FastAPI:
+    app = FastAPI(title="Fake Anthropic")
+    seen_prefixes: set[str] = set()
+    counters = {"requests": 0, "errors": 0, "streams": 0}
+
+    def usage_for(body: dict) -> dict:
+        system = body.get("system") or ""
+        system_text = system if isinstance(system, str) else "".join(block.get("text", "") for block in system)
+        system_tokens = len(system_text) // 4
+        message_tokens = sum(len(_text_of(msg["content"])) // 4 for msg in body.get("messages", []))
+        digest = hashlib.sha256(system_text.encode()).hexdigest()
+        cached = digest in seen_prefixes and not isinstance(system, str)
+        seen_prefixes.add(digest)
+        return {
+            "input_tokens": message_tokens + (0 if cached else system_tokens),
+            "cache_read_input_tokens": system_tokens if cached else 0,
+            "cache_creation_input_tokens": 0 if cached or isinstance(system, str) else system_tokens,
+        }
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        counters["requests"] += 1
+        if error_rate and random.random() < error_rate:
+            counters["errors"] += 1
+            await asyncio.sleep(_lognormal(ttft_ms / 4, sigma))
+            return JSONResponse(
+                {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}},
+                status_code=error_status,
+                headers={"retry-after": str(retry_after)},
+            )
+
+        usage = usage_for(body)
+        output_tokens = min(body.get("max_tokens", 4096), random.randint(min_tokens, max_tokens))
+        words = [random.choice(WORDS) for _ in range(output_tokens)]
+
+        if not body.get("stream"):
+            await asyncio.sleep(_lognormal(ttft_ms, sigma) + output_tokens * token_ms / 1000)
+            return {
+                "id": "msg_fake",
+                "type": "message",
+                "role": "assistant",
+                "model": body["model"],
+                "content": [{"type": "text", "text": " ".join(words)}],
+                "stop_reason": "end_turn",
+                "usage": dict(usage, output_tokens=output_tokens),
+            }
+
+        counters["streams"] += 1
+
+        async def events():
+            def event(kind: str, data: dict) -> str:
+                return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+            yield event("message_start", {"type": "message_start", "message": {
+                "id": "msg_fake", "model": body["model"], "usage": dict(usage, output_tokens=1)}})
+            await asyncio.sleep(_lognormal(ttft_ms, sigma))
+            yield event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                "content_block": {"type": "text", "text": ""}})
+            for i, word in enumerate(words):
+                yield event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": (" " if i else "") + word}})
+                await asyncio.sleep(token_ms / 1000)
+            yield event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                                          "usage": {"output_tokens": output_tokens}})
+            yield event("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    batches: dict[str, dict] = {}
+
+    def batch_view(batch: dict, request: Request) -> dict:
+        ended = time.monotonic() >= batch["ends_at"]
+        view = {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else len(batch["requests"]),
+                "succeeded": len(batch["requests"]) if ended else 0,
+                "errored": 0, "canceled": 0, "expired": 0,
+            },
+            "results_url": str(request.url_for("batch_results", batch_id=batch["id"])) if ended else None,
+        }
+        return view
+
+    @app.post("/v1/messages/batches")
+    async def create_batch(request: Request):
+        body = await request.json()
+        batch_id = f"msgbatch_{len(batches) + 1:06d}"
+        batches[batch_id] = {
+            "id": batch_id,
+            "requests": body["requests"],
+            # Batches finish after roughly one simulated call, however many requests they hold
+            "ends_at": time.monotonic() + _lognormal(ttft_ms, sigma) * 2,
+        }
+        counters["batches"] = counters.get("batches", 0) + 1
+        return batch_view(batches[batch_id], request)
+
+    @app.get("/v1/messages/batches/{batch_id}")
+    async def get_batch(batch_id: str, request: Request):
+        return batch_view(batches[batch_id], request)
+
+    @app.get("/v1/messages/batches/{batch_id}/results", name="batch_results")
+    async def batch_results(batch_id: str):
+        lines = []
+        for item in batches[batch_id]["requests"]:
+            params = item["params"]
+            output_tokens = random.randint(min_tokens, max_tokens)
+            lines.append(json.dumps({"custom_id": item["custom_id"], "result": {"type": "succeeded", "message": {
+                "id": "msg_fake", "type": "message", "role": "assistant", "model": params["model"],
+                "content": [{"type": "text", "text": " ".join(random.choice(WORDS) for _ in range(output_tokens))}],
+                "stop_reason": "end_turn",
+                "usage": dict(usage_for(params), output_tokens=output_tokens),
+            }}}))
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="application/x-jsonl")
+
+    @app.get("/__stats")
+    async def stats():
+        return counters
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Anthropic Messages API stand-in")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--ttft-ms", type=float, default=400.0, help="median time to first token")
+    parser.add_argument("--token-ms", type=float, default=15.0, help="time per output token")
+    parser.add_argument("--sigma", type=float, default=0.4, help="log-normal spread of the latency")
+    parser.add_argument("--min-tokens", type=int, default=40)
+    parser.add_argument("--max-tokens", type=int, default=250)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=529)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    args = parser.parse_args()
+    app = create_app(args.ttft_ms, args.token_ms, args.sigma, args.min_tokens, args.max_tokens,
+                     args.error_rate, args.error_status, args.retry_after)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,198 @@
+"""In-memory stand-in for the Supabase REST (PostgREST) API.
+
+Implements the subset of PostgREST the agent uses, so the real supabase-py
+client can be pointed at it with SUPABASE_URL=http://127.0.0.1:<port>:
+
+- GET    /rest/v1/<table>?select=..&col=eq.value&order=col.desc&limit=n
+- POST   /rest/v1/<table>            insert (object or array), upsert with on_conflict
+- PATCH  /rest/v1/<table>?col=eq.v   update matching rows
+- DELETE /rest/v1/<table>?col=eq.v   delete matching rows
+
+Filters: eq, neq, lt, lte, gt, gte, in, plus or=(...) of those.
+
+    python bench/fake_supabase.py --port 54321 --latency-ms 20
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from fastapi import FastAPI, Request, Response
+
+OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+}
+
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "or", "columns"}
+
+
+def _coerce(value: str, sample):
+    if isinstance(sample, bool):
+        return value == "true"
+    if isinstance(sample, int):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    return value
+
+
+def _parse_condition(column: str, expression: str):
+    operator, _, value = expression.partition(".")
+    if operator == "in":
+        options = [_unquote(option) for option in _split_or(value[1:-1])]
+        return lambda row: str(row.get(column)) in options
+    compare = OPERATORS[operator]
+    value = _unquote(value)
+    return lambda row: compare(row.get(column), _coerce(value, row.get(column)))
+
+
+def _split_or(expression: str) -> list[str]:
+    """Split the inside of or=(a.eq.1,and(b.gt.2,c.lt.3)) or in.(a,"b,c") on top-level commas"""
+    parts, depth, current, quoted, escaped = [], 0, "", False, False
+    for char in expression:
+        if quoted:
+            current += char
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                quoted = False
+            continue
+        if char == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        # A quote only opens a quoted value at the start of one
+        quoted = char == '"' and (not current or current.endswith("."))
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _parse_group(expression: str):
+    """A single or() member: col.op.value or and(col.op.value,...)"""
+    if expression.startswith("and(") and expression.endswith(")"):
+        conditions = [_parse_group(part) for part in _split_or(expression[4:-1])]
+        return lambda row: all(condition(row) for condition in conditions)
+    column, _, rest = expression.partition(".")
+    return _parse_condition(column, rest)
+
+
+def _filters(params) -> list:
+    conditions = []
+    for key, value in params.multi_items():
+        if key == "or":
+            members = [_parse_group(part) for part in _split_or(value.strip()[1:-1])]
+            conditions.append(lambda row, members=members: any(member(row) for member in members))
+        elif key not in RESERVED_PARAMS:
+            conditions.append(_parse_condition(key, value))
+    return conditions
+
+
+def _sort_key(value):
+    return (value is None, value)
+
+
+def create_app(latency_ms: float = 0.0, jitter_ms: float = 0.0) -> FastAPI:
+    app = FastAPI(title="Fake Supabase")
+    tables: dict[str, list[dict]] = {}
+    next_id = {"value": 1}
+
+    async def simulate_latency():
+        if latency_ms or jitter_ms:
+            await asyncio.sleep(max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000)
+
+    def matching(table: str, params) -> list[dict]:
+        conditions = _filters(params)
+        return [row for row in tables.get(table, []) if all(condition(row) for condition in conditions)]
+
+    @app.get("/rest/v1/{table}")
+    async def select(table: str, request: Request):
+        await simulate_latency()
+        rows = matching(table, request.query_params)
+        order = request.query_params.get("order")
+        if order:
+            for clause in reversed(order.split(",")):
+                column, *modifiers = clause.split(".")
+                rows.sort(key=lambda row: _sort_key(row.get(column)), reverse="desc" in modifiers)
+        offset = int(request.query_params.get("offset", 0))
+        limit = request.query_params.get("limit")
+        rows = rows[offset:offset + int(limit)] if limit else rows[offset:]
+        columns = request.query_params.get("select", "*")
+        if columns != "*":
+            names = [name.strip() for name in columns.split(",")]
+            rows = [{name: row.get(name) for name in names} for row in rows]
+        return rows
+
+    @app.post("/rest/v1/{table}")
+    async def insert(table: str, request: Request):
+        await simulate_latency()
+        payload = json.loads(await request.body())
+        new_rows = payload if isinstance(payload, list) else [payload]
+        rows = tables.setdefault(table, [])
+        conflict = request.query_params.get("on_conflict")
+        written = []
+        for row in new_rows:
+            row = dict(row)
+            if conflict:
+                keys = conflict.split(",")
+                existing = next((r for r in rows if all(r.get(k) == row.get(k) for k in keys)), None)
+                if existing is not None:
+                    existing.update(row)
+                    written.append(existing)
+                    continue
+            row.setdefault("id", next_id["value"])
+            next_id["value"] += 1
+            rows.append(row)
+            written.append(row)
+        return Response(json.dumps(written), status_code=201, media_type="application/json")
+
+    @app.patch("/rest/v1/{table}")
+    async def update(table: str, request: Request):
+        await simulate_latency()
+        changes = json.loads(await request.body())
+        rows = matching(table, request.query_params)
+        for row in rows:
+            row.update(changes)
+        return rows
+
+    @app.delete("/rest/v1/{table}")
+    async def delete(table: str, request: Request):
+        await simulate_latency()
+        doomed = matching(table, request.query_params)
+        ids = {id(row) for row in doomed}
+        tables[table] = [row for row in tables.get(table, []) if id(row) not in ids]
+        return doomed
+
+    @app.get("/__stats")
+    async def stats():
+        return {table: len(rows) for table, rows in tables.items()}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="In-memory Supabase REST stand-in")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency_ms, args.jitter_ms), host="127.0.0.1", port=args.port, log_level="warning")
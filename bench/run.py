@@ -0,0 +1,253 @@
+"""Load test the agent against local Supabase and Anthropic stand-ins.
+
+Starts bench/fake_supabase.py, bench/fake_anthropic.py and the agent itself
+(uvicorn main:app) as subprocesses on local ports, drives concurrent
+multi-session conversations through /chat and /chat/stream, and writes a
+JSON report with p50/p95/p99 latency, time to first token and throughput.
+
+    python bench/run.py --sessions 50 --turns 6 --concurrency 20 --stream-ratio 0.5
+    python bench/run.py --compare bench/results/<earlier>.json
+    python bench/run.py --workers 4 --compare bench/results/<one worker>.json
+
+Pass --agent-url to benchmark an agent that is already running (and already
+pointed at the stand-ins or anything else); no processes are started then.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+QUERIES = (
+    "gracias 💪",
+    "¿Cómo le respondo a este mensaje sobre el horario de los niños?",
+    "Necesito pensar la estrategia para la reunión con el abogado la próxima semana. "
+    "Quiero llegar con claridad sobre qué puedo ceder y qué no.",
+    "ok",
+    "Me siento abrumada con el negocio, hay tres clientes esperando y no sé por dónde empezar. "
+    "Ayúdame a priorizar sin que se me caiga todo lo demás.",
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start(args: list[str], env: dict = None) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL)
+
+
+async def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(samples: list[dict], key: str) -> dict:
+    values = [sample[key] for sample in samples if sample.get(key) is not None]
+    return {
+        "p50_ms": round(percentile(values, 0.50) * 1000, 1) if values else None,
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 1) if values else None,
+        "mean_ms": round(sum(values) / len(values) * 1000, 1) if values else None,
+    }
+
+
+async def one_turn(client: httpx.AsyncClient, body: dict, stream: bool) -> dict:
+    sample = {"endpoint": "chat_stream" if stream else "chat", "ttft": None}
+    started = time.perf_counter()
+    try:
+        if stream:
+            async with client.stream("POST", "/chat/stream", json=body) as response:
+                sample["status"] = response.status_code
+                async for line in response.aiter_lines():
+                    if line.startswith("event: delta") and sample["ttft"] is None:
+                        sample["ttft"] = time.perf_counter() - started
+                    elif line.startswith("event: error"):
+                        sample["status"] = 502
+        else:
+            response = await client.post("/chat", json=body)
+            sample["status"] = response.status_code
+    except httpx.HTTPError as e:
+        sample["status"] = type(e).__name__
+    sample["latency"] = time.perf_counter() - started
+    return sample
+
+
+async def drive(agent_url: str, sessions: int, turns: int, concurrency: int, stream_ratio: float,
+                think_ms: float, users: int, model: str) -> tuple[list[dict], float, dict | None]:
+    run_id = uuid.uuid4().hex[:8]
+    samples: list[dict] = []
+    gate = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+
+    async with httpx.AsyncClient(base_url=agent_url, timeout=120.0, limits=limits) as client:
+        async def conversation(index: int):
+            async with gate:
+                for _ in range(turns):
+                    body = {
+                        "query": random.choice(QUERIES),
+                        "session_id": f"bench-{run_id}-{index}",
+                        "user_id": f"bench-user-{index % users}",
+                        "model": model,
+                        "idempotency_key": uuid.uuid4().hex,
+                    }
+                    samples.append(await one_turn(client, body, random.random() < stream_ratio))
+                    if think_ms:
+                        await asyncio.sleep(random.expovariate(1000 / think_ms))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(conversation(i) for i in range(sessions)))
+        elapsed = time.perf_counter() - started
+
+        try:
+            health = (await client.get("/health")).json()
+        except (httpx.HTTPError, ValueError):
+            health = None
+    return samples, elapsed, health
+
+
+def build_report(args, samples: list[dict], elapsed: float, health: dict) -> dict:
+    ok = [s for s in samples if s["status"] == 200]
+    report = {
+        "started_at": datetime.utcnow().isoformat(),
+        "git_rev": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                  capture_output=True, text=True).stdout.strip() or None,
+        "config": {key: value for key, value in vars(args).items() if key != "compare"},
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "status_counts": {},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else None,
+        "latency": summarize(ok, "latency"),
+        "by_endpoint": {},
+        "ttft": summarize(ok, "ttft"),
+        "agent_health": health,
+    }
+    for sample in samples:
+        status = str(sample["status"])
+        report["status_counts"][status] = report["status_counts"].get(status, 0) + 1
+    for endpoint in ("chat", "chat_stream"):
+        subset = [s for s in ok if s["endpoint"] == endpoint]
+        if subset:
+            report["by_endpoint"][endpoint] = dict(summarize(subset, "latency"), requests=len(subset))
+    return report
+
+
+def compare(report: dict, baseline: dict):
+    rows = [("throughput_rps", report["throughput_rps"], baseline.get("throughput_rps"))]
+    for section in ("latency", "ttft"):
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            rows.append((f"{section}.{key}", report[section][key], baseline.get(section, {}).get(key)))
+    rows.append(("errors", report["errors"], baseline.get("errors")))
+    print(f"{'metric':<22}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current, before in rows:
+        change = f"{(current - before) / before * 100:+.1f}%" if current is not None and before else ""
+        print(f"{name:<22}{str(before):>12}{str(current):>12}{change:>10}")
+
+
+async def main(args):
+    processes = []
+    agent_url = args.agent_url
+    try:
+        if agent_url is None:
+            supabase_port, anthropic_port, agent_port = free_port(), free_port(), free_port()
+            # uvicorn reads WEB_CONCURRENCY as its worker count, which only the agent should get
+            base_env = {key: value for key, value in os.environ.items() if key != "WEB_CONCURRENCY"}
+            processes.append(start(["bench/fake_supabase.py", "--port", str(supabase_port),
+                                    "--latency-ms", str(args.db_latency_ms)], env=base_env))
+            processes.append(start(["bench/fake_anthropic.py", "--port", str(anthropic_port),
+                                    "--ttft-ms", str(args.ttft_ms), "--token-ms", str(args.token_ms),
+                                    "--error-rate", str(args.error_rate)], env=base_env))
+            env = dict(
+                base_env,
+                WEB_CONCURRENCY=str(args.workers),
+                SUPABASE_URL=f"http://127.0.0.1:{supabase_port}",
+                SUPABASE_KEY="bench",
+                ANTHROPIC_API_KEY="bench",
+                ANTHROPIC_URL=f"http://127.0.0.1:{anthropic_port}",
+                ANTHROPIC_HTTP2="false",
+            )
+            if args.workers > 1:
+                # A fresh shared-state file per run
+                env["SHARED_STATE_PATH"] = os.path.join(tempfile.gettempdir(), f"amaru-bench-{agent_port}.db")
+            await wait_ready(f"http://127.0.0.1:{supabase_port}/__stats")
+            await wait_ready(f"http://127.0.0.1:{anthropic_port}/__stats")
+            processes.append(start(["-m", "uvicorn", "main:app", "--port", str(agent_port),
+                                    "--log-level", "warning", *args.uvicorn_args], env=env))
+            agent_url = f"http://127.0.0.1:{agent_port}"
+            await wait_ready(f"{agent_url}/ready")
+
+        samples, elapsed, health = await drive(agent_url, args.sessions, args.turns, args.concurrency,
+                                               args.stream_ratio, args.think_ms, args.users, args.model)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    report = build_report(args, samples, elapsed, health)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = args.output or os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{report['requests']} requests, {report['errors']} errors in {report['elapsed_s']}s "
+          f"({report['throughput_rps']} req/s)")
+    print(f"latency {report['latency']}")
+    print(f"ttft    {report['ttft']}")
+    print(f"report  {path}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark /chat and /chat/stream against local stand-ins")
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=5, help="turns per session, sent one after another")
+    parser.add_argument("--concurrency", type=int, default=20, help="sessions in progress at once")
+    parser.add_argument("--stream-ratio", type=float, default=0.5)
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a session's turns")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--model", default="claude-sonnet-4-5-20250929")
+    parser.add_argument("--ttft-ms", type=float, default=400.0)
+    parser.add_argument("--token-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--db-latency-ms", type=float, default=20.0)
+    parser.add_argument("--workers", type=int, default=1, help="agent worker processes (WEB_CONCURRENCY)")
+    parser.add_argument("--agent-url", help="benchmark a running agent instead of starting one")
+    parser.add_argument("--uvicorn-args", nargs=argparse.REMAINDER, default=[],
+                        help="extra arguments for the agent's uvicorn, e.g. --workers 4")
+    parser.add_argument("--output", help="report path (default bench/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier report to compare against")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,72 @@
+"""Show that concurrent storage calls overlap instead of running one after another.
+
+Replaces the Supabase client with a stand-in whose every round trip blocks for
+a fixed time (like the real sync client does on the network), then fires N
+concurrent history loads and saves.
+
+    python bench/storage_concurrency.py --requests 32 --rtt-ms 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class SlowResult:
+    data = []
+
+
+class SlowQuery:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(self.rtt)
+        return SlowResult()
+
+
+class SlowClient:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+
+    def table(self, name):
+        return SlowQuery(self.rtt)
+
+
+async def run(requests: int, rtt: float) -> dict:
+    main.supabase = SlowClient(rtt)
+
+    async def one_turn(i: int):
+        session_id = f"bench-{i}"
+        await main.load_conversation_history(session_id)
+        await main.save_conversation_turn(session_id, "bench", "user", "hola")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_turn(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    serial = requests * 2 * rtt
+    return {
+        "requests": requests,
+        "rtt_ms": rtt * 1000,
+        "workers": main.SUPABASE_MAX_WORKERS,
+        "elapsed_s": round(elapsed, 3),
+        "serial_s": round(serial, 3),
+        "overlap": round(serial / elapsed, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--rtt-ms", type=float, default=50.0)
+    args = parser.parse_args()
+    print(asyncio.run(run(args.requests, args.rtt_ms / 1000)))
@@ -0,0 +1,126 @@
+"""Run the same latency measurements against each storage backend.
+
+The behaviour every ConversationStorage implementation must share is checked
+by tests/test_storage_conformance.py, over sqlite and bench/fake_supabase.py;
+this script only times the same workload on each backend.
+
+    python bench/storage_latency.py                      # sqlite and supabase
+    python bench/storage_latency.py --backend sqlite --iterations 500
+
+The supabase backend uses SUPABASE_URL / SUPABASE_KEY when set (e.g. a local
+`supabase start` with migrations applied) and otherwise starts
+bench/fake_supabase.py, whose numbers then only show the cost of a local
+HTTP round trip, not of a real Supabase over the internet.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+
+def make_rows(session_id: str, count: int, user_id: str = "conformance") -> list[dict]:
+    return [{
+        "session_id": session_id,
+        "user_id": user_id,
+        "role": "user" if i % 2 == 0 else "assistant",
+        "content": f"turn {i}",
+        "model_used": "conformance-model",
+        "timestamp": main.next_timestamp().isoformat(),
+    } for i in range(count)]
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1] * 1000, 3),
+    }
+
+
+def latency(store: main.ConversationStorage, iterations: int) -> dict:
+    session = f"lat-{uuid.uuid4().hex[:8]}"
+    store.insert_turns(make_rows(session, main.HISTORY_LOAD_TURNS))
+    through = main.next_timestamp().isoformat()
+    operations = {
+        "select_history": lambda: store.select_history(session, main.HISTORY_LOAD_TURNS),
+        "insert_turns": lambda: store.insert_turns(make_rows(f"{session}-w", 2)),
+        "select_summary": lambda: store.select_summary(session),
+        "upsert_summary": lambda: store.upsert_summary({"session_id": session, "summary": "s", "summarized_through": through,
+                                                        "turns_summarized": 1, "updated_at": through}),
+    }
+    results = {}
+    for name, operation in operations.items():
+        operation()
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - started)
+        results[name] = percentiles(samples)
+    return results
+
+
+def start_fake_supabase() -> subprocess.Popen:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, "bench/fake_supabase.py", "--port", str(port),
+                                "--latency-ms", "0", "--jitter-ms", "0"], cwd=ROOT, stdout=subprocess.DEVNULL)
+    main.SUPABASE_URL, main.SUPABASE_KEY = f"http://127.0.0.1:{port}", "conformance"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{main.SUPABASE_URL}/__stats")
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("fake Supabase did not start")
+
+
+def run(args) -> int:
+    report = {}
+    fake = None
+    try:
+        for backend in args.backend:
+            if backend == "sqlite":
+                store = main.SQLiteStorage(os.path.join(tempfile.mkdtemp(), "latency.db"))
+            else:
+                if not (main.SUPABASE_URL and main.SUPABASE_KEY):
+                    fake = start_fake_supabase()
+                store = main.SupabaseStorage()
+            report[backend] = latency(store, args.iterations)
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.wait(timeout=10)
+
+    if report:
+        print(f"\nlatency over {args.iterations} iterations" + (" (supabase = local fake)" if fake else ""))
+        print(f"{'operation':<16}" + "".join(f"{backend + ' p50/p95 ms':>28}" for backend in report))
+        for operation in next(iter(report.values())):
+            cells = "".join(f"{report[b][operation]['p50_ms']:>18} / {report[b][operation]['p95_ms']:<7}" for b in report)
+            print(f"{operation:<16}{cells}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage backend latency comparison")
+    parser.add_argument("--backend", action="append", choices=["sqlite", "supabase"],
+                        help="backend to time; repeatable (default: both)")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    args.backend = args.backend or ["sqlite", "supabase"]
+    sys.exit(run(args))
@@ -0,0 +1,104 @@
+"""Export stored conversations as NDJSON, one turn per line, ordered by (session_id, timestamp).
+
+Pages through the stored turns by keyset on (session_id, timestamp), on any
+STORAGE_BACKEND, so only one page is ever in memory whatever the history size.
+Output to a .gz file (or with --gzip) is written as one gzip member per page,
+which gzip, zcat and gzip.open read as a single stream.
+
+With --out, a checkpoint <out>.cursor is saved after each page is on disk,
+holding the resume cursor and the output length at that point. --resume cuts
+the output back to the checkpoint and continues from its cursor, so an
+interrupted export finishes with no repeated or partial rows. The cursor is
+also printed when the export stops; --after takes it, as does
+GET /admin/export?after=.
+
+    python export.py --out all.ndjson.gz
+    python export.py --session abc > abc.ndjson
+    python export.py --out all.ndjson.gz --resume
+    python export.py --after <cursor> --out rest.ndjson
+"""
+import argparse
+import json
+import os
+import sys
+
+import main
+
+
+def read_checkpoint(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path: str, checkpoint: dict):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temporary, path)
+
+
+def run(args) -> int:
+    compress = args.gzip or bool(args.out and args.out.endswith(".gz"))
+    checkpoint_path = f"{args.out}.cursor" if args.out else None
+    checkpoint = {"sessions": args.session, "gzip": compress, "cursor": args.after, "bytes": 0, "turns": 0}
+
+    if args.resume:
+        if not args.out:
+            sys.exit("--resume needs --out")
+        saved = read_checkpoint(checkpoint_path)
+        if saved is None:
+            sys.exit(f"no checkpoint at {checkpoint_path}")
+        if saved["sessions"] != args.session or saved["gzip"] != compress:
+            sys.exit(f"{checkpoint_path} is for a different export (sessions {saved['sessions']}, gzip {saved['gzip']})")
+        checkpoint = saved
+    after = main.parse_export_cursor(checkpoint["cursor"]) if checkpoint["cursor"] else None
+
+    if args.out:
+        out = open(args.out, "r+b" if args.resume else "wb")
+        out.truncate(checkpoint["bytes"])
+        out.seek(checkpoint["bytes"])
+    else:
+        out = sys.stdout.buffer
+
+    status = 0
+    try:
+        for rows in main.iter_conversation_turn_pages(args.session, args.page_size, after):
+            checkpoint["bytes"] += out.write(main.encode_export_page(rows, compress))
+            checkpoint["turns"] += len(rows)
+            checkpoint["cursor"] = main.export_cursor(rows[-1])
+            out.flush()
+            if checkpoint_path:
+                os.fsync(out.fileno())
+                write_checkpoint(checkpoint_path, checkpoint)
+    except KeyboardInterrupt:
+        status = 130
+    except Exception as e:
+        print(f"Error exporting conversations: {e}", file=sys.stderr)
+        status = 1
+    finally:
+        if args.out:
+            out.close()
+
+    state = "exported" if status == 0 else "stopped after"
+    print(f"{state} {checkpoint['turns']} turns; cursor {checkpoint['cursor'] or '(start)'}", file=sys.stderr)
+    if status and checkpoint["cursor"]:
+        hint = f"--out {args.out} --resume" if args.out else f"--after {checkpoint['cursor']}"
+        print(f"continue with: python export.py {hint}", file=sys.stderr)
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--session", action="append", help="only this session; repeatable (default: all sessions)")
+    parser.add_argument("--out", help="output file (default: stdout); .gz compresses")
+    parser.add_argument("--gzip", action="store_true", help="compress even when --out does not end in .gz")
+    parser.add_argument("--after", help="start after this cursor")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted export from <out>.cursor")
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+    if args.resume and args.after:
+        parser.error("--resume and --after cannot be combined")
+    sys.exit(run(args))
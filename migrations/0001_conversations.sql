@@ -0,0 +1,10 @@
+-- Conversation turns, one row per user or assistant message (see save_conversation_turns)
+CREATE TABLE IF NOT EXISTS amaru_paty_conversations (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
+    content TEXT NOT NULL,
+    model_used TEXT,
+    "timestamp" TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+-- Serves the history query (session_id = ? ORDER BY timestamp DESC LIMIT n, plus its
+-- timestamp < cursor keyset pages) and replay.py's (session_id, timestamp) keyset scan
+-- as plain index range scans. Built concurrently so existing deployments keep writing.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS amaru_paty_conversations_session_timestamp
+    ON amaru_paty_conversations (session_id, "timestamp");
@@ -0,0 +1,8 @@
+-- Rolling per-session summaries (see update_session_summary); SUMMARY_TABLE defaults to this name
+CREATE TABLE IF NOT EXISTS amaru_paty_summaries (
+    session_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL DEFAULT '',
+    summarized_through TIMESTAMPTZ,
+    turns_summarized INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,20 @@
+-- Index of archived conversation segments (see archive.py): one gzip JSONL object per
+-- session, month and compaction run, holding turns moved out of amaru_paty_conversations.
+-- hot_deleted is set once the segment's rows are gone from the hot table, so an
+-- interrupted compaction finishes the delete on its next run.
+CREATE TABLE IF NOT EXISTS amaru_paty_archive_segments (
+    object_key TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    month TEXT NOT NULL,
+    first_timestamp TIMESTAMPTZ NOT NULL,
+    last_timestamp TIMESTAMPTZ NOT NULL,
+    turns INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    raw_bytes INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    hot_deleted BOOLEAN NOT NULL DEFAULT false,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS amaru_paty_archive_segments_session
+    ON amaru_paty_archive_segments (session_id, first_timestamp);
@@ -0,0 +1,190 @@
+"""Offline bulk replay of stored conversations through the Message Batches API.
+
+Pages through the stored conversations (read-only, on any STORAGE_BACKEND),
+rebuilds the context each stored user turn had - the earlier turns of its
+session, windowed to the model's token budget like /chat does - and submits
+one Messages request per turn in batches at batch pricing. When the batches end, the new responses are
+written next to the stored ones in a comparison report.
+
+Nothing is written to storage. Corpus context was never stored, so replays
+run without it; the rolling summary is not used either, since the stored one
+reflects the session's current state rather than the replayed turn's.
+
+    python replay.py --prompt-version 3.4.0 --limit 500
+    python replay.py --prompt-file draft.md --limit 500
+    python replay.py --session abc --session def --model claude-haiku-4-5-20251001
+
+Point ANTHROPIC_URL / SUPABASE_URL at bench/fake_anthropic.py and
+bench/fake_supabase.py to try it without touching real services.
+"""
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+import httpx
+
+import main
+
+
+def build_replay_turns(rows, model: str = None, limit: int = None):
+    """Pair each stored user turn with its stored reply and the history that preceded it"""
+    turns = []
+    history: list[dict] = []
+    current_session = None
+    pending_user, pending_history = None, []
+    for row in rows:
+        if row["session_id"] != current_session:
+            current_session, history, pending_user = row["session_id"], [], None
+
+        if row["role"] == "user":
+            pending_user, pending_history = row, list(history)
+        elif row["role"] == "assistant" and pending_user is not None:
+            turn_model = model or pending_user.get("model_used") or row.get("model_used") or main.DEFAULT_MODEL
+            budget = main.history_token_budget(turn_model)
+            window = pending_history[main._fit_window(pending_history, budget):]
+            turns.append({
+                "custom_id": f"turn-{len(turns):06d}",
+                "session_id": current_session,
+                "timestamp": pending_user["timestamp"],
+                "model": turn_model,
+                "query": pending_user["content"],
+                "original": row["content"],
+                "original_model": row.get("model_used"),
+                "history_turns": len(window),
+                "messages": [{"role": t["role"], "content": t["content"]} for t in window]
+                            + [{"role": "user", "content": pending_user["content"]}],
+            })
+            if limit and len(turns) >= limit:
+                return turns
+            pending_user = None
+
+        history.append(row)
+    return turns
+
+
+def submit_batch(client: httpx.Client, turns: list[dict], system_prompt: str) -> str:
+    requests = [{
+        "custom_id": turn["custom_id"],
+        "params": main.build_claude_payload(turn["model"], system_prompt, turn["messages"]),
+    } for turn in turns]
+    response = client.post("/v1/messages/batches", json={"requests": requests})
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def wait_for_batch(client: httpx.Client, batch_id: str, poll_interval: float) -> dict:
+    while True:
+        response = client.get(f"/v1/messages/batches/{batch_id}")
+        response.raise_for_status()
+        batch = response.json()
+        if batch["processing_status"] == "ended":
+            return batch
+        print(f"{batch_id}: {batch['request_counts']}")
+        time.sleep(poll_interval)
+
+
+def fetch_results(client: httpx.Client, batch: dict) -> dict[str, dict]:
+    response = client.get(batch["results_url"])
+    response.raise_for_status()
+    results = {}
+    for line in response.text.splitlines():
+        if line.strip():
+            item = json.loads(line)
+            results[item["custom_id"]] = item["result"]
+    return results
+
+
+def compare_turn(turn: dict, result: dict | None) -> dict:
+    record = {key: turn[key] for key in ("session_id", "timestamp", "model", "original_model", "history_turns", "query", "original")}
+    if result is None or result.get("type") != "succeeded":
+        record.update(status=(result or {}).get("type", "missing"), replay=None, error=(result or {}).get("error"))
+        return record
+    message = result["message"]
+    replay = "".join(block.get("text", "") for block in message["content"] if block.get("type") == "text")
+    record.update(
+        status="succeeded",
+        replay=replay,
+        usage=message.get("usage"),
+        original_chars=len(turn["original"]),
+        replay_chars=len(replay),
+        similarity=round(difflib.SequenceMatcher(None, turn["original"], replay).ratio(), 4),
+    )
+    return record
+
+
+def summarize(records: list[dict], system_prompt: str) -> dict:
+    succeeded = [r for r in records if r["status"] == "succeeded"]
+    summary = {
+        "created_at": datetime.utcnow().isoformat(),
+        "prompt_sha256": hashlib.sha256(system_prompt.encode()).hexdigest(),
+        "turns": len(records),
+        "succeeded": len(succeeded),
+        "failed": len(records) - len(succeeded),
+        "sessions": len({r["session_id"] for r in records}),
+    }
+    if succeeded:
+        summary["mean_similarity"] = round(sum(r["similarity"] for r in succeeded) / len(succeeded), 4)
+        summary["mean_original_chars"] = round(sum(r["original_chars"] for r in succeeded) / len(succeeded), 1)
+        summary["mean_replay_chars"] = round(sum(r["replay_chars"] for r in succeeded) / len(succeeded), 1)
+        summary["least_similar"] = [
+            {key: r[key] for key in ("session_id", "timestamp", "similarity")}
+            for r in sorted(succeeded, key=lambda r: r["similarity"])[:10]
+        ]
+    return summary
+
+
+def run(args):
+    if not main.ANTHROPIC_API_KEY:
+        raise SystemExit("ANTHROPIC_API_KEY not set")
+    system_prompt = main.load_prompt(args.prompt_version).text if args.prompt_version else main.get_prompt().text
+    if args.prompt_file:
+        with open(args.prompt_file) as f:
+            system_prompt = f.read()
+
+    turns = build_replay_turns(main.iter_conversation_turns(args.session, args.page_size), args.model, args.limit)
+    print(f"Replaying {len(turns)} turns from {len({t['session_id'] for t in turns})} sessions")
+    if not turns:
+        return
+
+    results = {}
+    with httpx.Client(base_url=main.ANTHROPIC_URL, headers=main.anthropic_headers(), timeout=120.0) as client:
+        batch_ids = []
+        for start in range(0, len(turns), args.batch_size):
+            batch_ids.append(submit_batch(client, turns[start:start + args.batch_size], system_prompt))
+            print(f"Submitted {batch_ids[-1]}")
+        for batch_id in batch_ids:
+            batch = wait_for_batch(client, batch_id, args.poll_interval)
+            results.update(fetch_results(client, batch))
+
+    records = [compare_turn(turn, results.get(turn["custom_id"])) for turn in turns]
+    summary = summarize(records, system_prompt)
+
+    os.makedirs(args.output, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    turns_path = os.path.join(args.output, f"replay-{stamp}.jsonl")
+    with open(turns_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    summary_path = os.path.join(args.output, f"replay-{stamp}.summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    print(json.dumps({key: value for key, value in summary.items() if key != "least_similar"}))
+    print(f"Report: {turns_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay stored conversations through the Message Batches API")
+    parser.add_argument("--prompt-file", help="system prompt to replay with (default: the active registry version)")
+    parser.add_argument("--prompt-version", help="prompt registry version to replay with, e.g. 3.3.1")
+    parser.add_argument("--model", help="model for every turn (default: the model each turn originally used)")
+    parser.add_argument("--session", action="append", help="only replay this session; repeatable")
+    parser.add_argument("--limit", type=int, help="maximum number of turns to replay")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--poll-interval", type=float, default=30.0)
+    parser.add_argument("--output", default="replays")
+    run(parser.parse_args())
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+# Settings are read at import, so they are set before main is imported
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "amaru-test.db")
+os.environ["JOBS_PATH"] = os.path.join(tempfile.mkdtemp(), "amaru-jobs-test.db")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeAnthropic:
+    """Messages API stand-in that answers after `delay` seconds and records every request"""
+
+    def __init__(self, delay: float = 0.2):
+        self.delay = delay
+        self.requests: list[dict] = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            return httpx.Response(200, json={"data": []})
+        body = json.loads(request.content)
+        self.requests.append(body)
+        await asyncio.sleep(self.delay)
+        usage = {"input_tokens": 10, "output_tokens": 2, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+        if not body.get("stream"):
+            return httpx.Response(200, json={"content": [{"type": "text", "text": "Hola Paty"}], "usage": usage})
+        events = [
+            {"type": "message_start", "message": {"usage": usage}},
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Hola"}},
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": " Paty"}},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 2}},
+            {"type": "message_stop"},
+        ]
+        content = "".join(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in events)
+        return httpx.Response(200, content=content.encode(), headers={"content-type": "text/event-stream"})
+
+
+@pytest.fixture
+def anthropic(monkeypatch) -> FakeAnthropic:
+    fake = FakeAnthropic()
+    monkeypatch.setattr(main, "create_anthropic_client", lambda: httpx.AsyncClient(
+        base_url=main.ANTHROPIC_URL, transport=httpx.MockTransport(fake)))
+    return fake
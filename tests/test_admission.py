@@ -0,0 +1,122 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from test_idempotency import run_with_app, started
+
+
+def limiter(limit: int = 1, max_queue: int = 4, max_wait: float = 5.0) -> main.AdmissionLimiter:
+    return main.AdmissionLimiter("test", limit, max_queue, max_wait)
+
+
+def assert_overloaded(error: HTTPException, reason: str):
+    assert error.status_code == 503 and reason in error.detail
+    assert error.headers == {"Retry-After": str(main.CHAT_RETRY_AFTER)}
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    admission = limiter()
+    admitted = []
+
+    async def wait_turn(n: int):
+        await admission.acquire()
+        admitted.append(n)
+
+    async def scenario():
+        await admission.acquire()
+        waiters = []
+        for n in range(3):
+            waiters.append(asyncio.create_task(wait_turn(n)))
+            await asyncio.sleep(0)
+        for _ in range(3):
+            admission.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+        admission.release()
+
+    asyncio.run(scenario())
+    assert admitted == [0, 1, 2]
+    assert admission.idle and admission.stats["queued"] == 3
+
+
+def test_a_full_queue_is_rejected_with_retry_after():
+    admission = limiter(max_queue=1)
+
+    async def scenario():
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire()
+        admission.release()
+        await waiter
+        admission.release()
+        return error.value
+
+    assert_overloaded(asyncio.run(scenario()), "queue full")
+    assert admission.stats["rejected_queue_full"] == 1 and admission.idle
+
+
+def test_a_waiter_gives_up_after_the_max_queue_wait():
+    admission = limiter(max_wait=0.05)
+
+    async def scenario():
+        await admission.acquire()
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire()
+        # The timed-out waiter left the queue, so the slot is not handed to it
+        admission.release()
+        return error.value
+
+    assert_overloaded(asyncio.run(scenario()), "queue wait exceeded")
+    assert admission.stats["rejected_timeout"] == 1 and admission.idle
+
+
+def test_per_user_limit_only_holds_back_that_user(monkeypatch):
+    monkeypatch.setattr(main, "chat_admission", limiter(limit=10))
+    monkeypatch.setattr(main, "CHAT_USER_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(main, "CHAT_USER_MAX_QUEUE", 0)
+    monkeypatch.setattr(main, "user_admission", {})
+    rejected = main.user_admission_stats["rejected"]
+
+    async def scenario():
+        paty = await main.admit(main.AgentRequest(query="hola", user_id="paty"))
+        with pytest.raises(HTTPException) as error:
+            await main.admit(main.AgentRequest(query="otra vez", user_id="paty"))
+        other = await main.admit(main.AgentRequest(query="hola", user_id="carlos"))
+        paty()
+        other()
+        return error.value
+
+    assert_overloaded(asyncio.run(scenario()), "user paty")
+    assert main.user_admission_stats["rejected"] == rejected + 1
+    assert main.user_admission == {} and main.chat_admission.idle
+
+
+def test_idempotent_duplicates_do_not_take_a_slot(monkeypatch, anthropic):
+    monkeypatch.setattr(main, "chat_admission", limiter(max_queue=0))
+    session_id = f"admission-{uuid.uuid4().hex}"
+    body = {"query": "hola", "session_id": session_id, "idempotency_key": "k1"}
+
+    async def scenario(client):
+        first = asyncio.create_task(client.post("/chat", json=body))
+        await started((session_id, "k1"))
+        for _ in range(100):
+            if main.chat_admission.in_flight:
+                break
+            await asyncio.sleep(0.01)
+        # Both arrive while the first turn holds the only slot
+        duplicate, other = await asyncio.gather(
+            client.post("/chat", json=body),
+            client.post("/chat", json=dict(body, idempotency_key="k2")),
+        )
+        return await first, duplicate, other
+
+    first, duplicate, other = run_with_app(scenario)
+    assert first.status_code == duplicate.status_code == 200
+    assert duplicate.json() == first.json()
+    assert other.status_code == 503 and other.headers["Retry-After"] == str(main.CHAT_RETRY_AFTER)
+    assert len(anthropic.requests) == 1
@@ -0,0 +1,70 @@
+import json
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def empty_store(monkeypatch):
+    monkeypatch.setattr(main, "corpus_store", OrderedDict())
+    monkeypatch.setattr(main, "corpus_store_bytes", 0)
+    monkeypatch.setattr(main, "session_corpus", OrderedDict())
+    monkeypatch.setattr(main, "corpus_stats", dict.fromkeys(main.corpus_stats, 0))
+
+
+def test_normalization_drops_cosmetic_differences_and_repeated_chunks():
+    text = "Juan Jose: co-parent  \r\n  shared custody\r\n\r\n\r\nMaria: daughter\n\n  Juan Jose: co-parent\n  shared custody  \n\n\n"
+    # Indentation inside a chunk is kept; only the chunk's own edges and line ends are trimmed
+    assert main.normalize_corpus(text) == "Juan Jose: co-parent\n  shared custody\n\nMaria: daughter"
+    assert main.corpus_stats["duplicate_chunks_dropped"] == 1
+
+
+def test_equal_corpora_are_stored_once(monkeypatch):
+    first = main.store_corpus("a" * 10)
+    assert main.store_corpus("a" * 10) == first
+    assert list(main.corpus_store) == [first] and main.corpus_store_bytes == 10
+
+    monkeypatch.setattr(main, "CORPUS_STORE_MAX_BYTES", 25)
+    second = main.store_corpus("b" * 10)
+    main.store_corpus("a" * 10)
+    # Over the byte budget the least recently used entry goes
+    third = main.store_corpus("c" * 10)
+    assert list(main.corpus_store) == [first, third] and second not in main.corpus_store
+    assert main.corpus_store_bytes == 20
+
+
+def test_a_repeated_corpus_counts_as_reused():
+    session_id = f"corpus-{uuid.uuid4().hex}"
+    text = main.resolve_corpus_context(session_id, "Maria: daughter\n\nPiki: son")
+    again = main.resolve_corpus_context(session_id, "Maria: daughter   \r\n\r\nPiki: son\n")
+    assert again is text
+    assert main.resolve_corpus_context(f"other-{session_id}", "Maria: daughter\n\nPiki: son") is text
+    main.resolve_corpus_context(session_id, "Maria: daughter")
+
+    stats = main.corpus_stats
+    assert (stats["turns_with_corpus"], stats["changed"], stats["unchanged"]) == (4, 3, 1)
+    assert stats["bytes_reused"] == len(text) and stats["tokens_reused"] == main.estimate_tokens(text)
+    assert main.resolve_corpus_context(session_id, None) is None and stats["turns_with_corpus"] == 4
+
+
+def test_block_order_puts_the_corpus_last_in_the_system_prompt(monkeypatch):
+    monkeypatch.setattr(main, "PROMPT_CACHE_ENABLED", True)
+    messages = [{"role": "user", "content": "hola"}, {"role": "assistant", "content": "hola Paty"},
+                {"role": "user", "content": "¿qué hago?"}]
+    payload = main.build_claude_payload("claude-test", "prompt", messages, summary="resumen", corpus="Maria: daughter")
+
+    system = payload["system"]
+    assert [block["text"].split("\n")[0] for block in system] == [
+        "prompt", "<conversation_summary>", "Context retrieved from the corpus for Paty's current message:"]
+    assert all("cache_control" in block for block in system)
+    # The history breakpoint stays on the last turn before the new message, after every system block
+    assert payload["messages"][1]["content"][0]["cache_control"] == main.cache_control()
+    assert payload["messages"][2] == {"role": "user", "content": "¿qué hago?"}
+
+    prompt = main.get_prompt()
+    encoded = main.encode_claude_body("claude-test", prompt, messages, summary="resumen", corpus="Maria: daughter")
+    assert json.loads(encoded) == main.build_claude_payload("claude-test", prompt.text, messages,
+                                                            summary="resumen", corpus="Maria: daughter")
@@ -0,0 +1,51 @@
+import asyncio
+import base64
+import json
+import uuid
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def sessions():
+    sessions = sorted(f"export-{uuid.uuid4().hex}" for _ in range(2))
+    main.get_storage().insert_turns([{
+        "session_id": session_id,
+        "user_id": "paty",
+        "role": role,
+        "content": f"{session_id} {n}",
+        "model_used": None,
+        "timestamp": main.next_timestamp().isoformat(),
+    } for session_id in sessions for n, role in enumerate(["user", "assistant", "user"])])
+    return sessions
+
+
+def test_sync_and_async_pages_match_and_resume_from_a_cursor(sessions):
+    pages = list(main.iter_conversation_turn_pages(sessions, page_size=3))
+    assert [len(rows) for rows in pages] == [3, 3]
+    assert [row["content"] for row in pages[1]] == [f"{sessions[1]} {n}" for n in range(3)]
+
+    async def collect():
+        return [rows async for rows in main.aiter_conversation_turn_pages(sessions, page_size=3)]
+    assert asyncio.run(collect()) == pages
+
+    after = main.parse_export_cursor(main.export_cursor(pages[0][-1]))
+    assert list(main.iter_conversation_turns(sessions, page_size=2, after=after)) == pages[1]
+
+
+@pytest.mark.parametrize("token", [["s", "not-a-timestamp"], ["s", 12], ["s"], "garbage"])
+def test_malformed_cursor_is_rejected_with_422(monkeypatch, token):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    cursor = base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+    async def export():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            return await client.get("/admin/export", params={"after": cursor},
+                                    headers={"Authorization": "Bearer secret"})
+
+    response = asyncio.run(export())
+    assert response.status_code == 422
+    assert "invalid export cursor" in response.json()["detail"]
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(main, "history_cache", OrderedDict())
+    monkeypatch.setattr(main, "history_cache_bytes", 0)
+    monkeypatch.setattr(main, "history_cache_loading", {})
+
+
+def turns(*contents: str) -> list[dict]:
+    return [{"role": "user", "content": content, "timestamp": main.next_timestamp().isoformat()} for content in contents]
+
+
+def test_a_load_racing_a_save_does_not_fill_the_cache(monkeypatch):
+    session_id = f"race-{uuid.uuid4().hex}"
+    reading, release = threading.Event(), threading.Event()
+    select = main._select_history
+
+    def slow_select(*args):
+        rows = select(*args)
+        reading.set()
+        release.wait(5)
+        return rows
+
+    monkeypatch.setattr(main, "_select_history", slow_select)
+
+    async def scenario():
+        load = asyncio.create_task(main.load_conversation_history(session_id, limit=main.HISTORY_CACHE_TURNS))
+        await asyncio.get_running_loop().run_in_executor(None, reading.wait, 5)
+        # Saved after the read began, so the rows being loaded are already stale
+        await main.save_conversation_turns(session_id, "paty", [("user", "hola"), ("assistant", "hola Paty")])
+        release.set()
+        await load
+
+    asyncio.run(scenario())
+    assert session_id not in main.history_cache
+
+    asyncio.run(main.load_conversation_history(session_id, limit=main.HISTORY_CACHE_TURNS))
+    assert [content for _, content, _ in main.history_cache[session_id]["turns"]] == ["hola", "hola Paty"]
+
+
+def test_expired_sessions_are_misses(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_CACHE_TTL", 0.01)
+    main.history_cache_fill("ttl", turns("hola"))
+    assert main.history_cache_get("ttl", 10) is not None
+    time.sleep(0.02)
+    expirations = main.history_cache_stats["expirations"]
+    assert main.history_cache_get("ttl", 10) is None
+    assert main.history_cache_stats["expirations"] == expirations + 1
+    assert "ttl" not in main.history_cache and main.history_cache_bytes == 0
+
+
+def test_the_byte_budget_evicts_least_recently_used_sessions(monkeypatch):
+    main.history_cache_fill("a", turns("x" * 1000))
+    per_session = main.history_cache_bytes
+    monkeypatch.setattr(main, "HISTORY_CACHE_MAX_BYTES", per_session * 2)
+    main.history_cache_fill("b", turns("x" * 1000))
+    assert main.history_cache_get("a", 10) is not None
+
+    evictions = main.history_cache_stats["evictions"]
+    main.history_cache_fill("c", turns("x" * 1000))
+    assert list(main.history_cache) == ["a", "c"]
+    assert main.history_cache_bytes == per_session * 2
+    assert main.history_cache_stats["evictions"] == evictions + 1
+
+
+def test_the_turn_ring_keeps_the_newest_turns(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_CACHE_TURNS", 3)
+    main.history_cache_fill("ring", turns("1", "2"))
+    main.history_cache_append("ring", turns("3", "4"))
+    assert [row["content"] for row in main.history_cache_get("ring", 3)] == ["2", "3", "4"]
+    assert main.history_cache_bytes == main.history_cache["ring"]["bytes"]
+
+
+def test_dropped_writes_invalidate_the_session(monkeypatch):
+    def failing_insert(rows):
+        raise RuntimeError("storage down")
+
+    monkeypatch.setattr(main, "WRITE_RETRIES", 1)
+    monkeypatch.setattr(main, "_insert_turns", failing_insert)
+    session_id = f"dropped-{uuid.uuid4().hex}"
+    main.history_cache_fill(session_id, [])
+    rows = [dict(row, session_id=session_id, user_id="paty", model_used=None) for row in turns("hola")]
+    main.history_cache_append(session_id, rows)
+
+    asyncio.run(main.write_batch(rows))
+    assert session_id not in main.history_cache
+    # The next load goes back to storage, which never got the turn
+    assert asyncio.run(main.load_conversation_history(session_id, limit=main.HISTORY_CACHE_TURNS)) == []
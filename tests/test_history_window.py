@@ -0,0 +1,118 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+
+import main
+
+
+class FakeSummaryModel:
+    """_send_claude stand-in answering every request with a fixed summary; `hold` delays the answer"""
+
+    def __init__(self):
+        self.requests: list[dict] = []
+        self.hold: asyncio.Event | None = None
+
+    async def __call__(self, payload: dict, stream: bool = False) -> httpx.Response:
+        self.requests.append(payload)
+        if self.hold is not None:
+            await self.hold.wait()
+        return httpx.Response(200, json={"content": [{"type": "text", "text": " Resumen: hola \n"}], "usage": {}})
+
+
+@pytest.fixture
+def summarizer(monkeypatch) -> FakeSummaryModel:
+    fake = FakeSummaryModel()
+    monkeypatch.setattr(main, "_send_claude", fake)
+    monkeypatch.setattr(main, "HEDGE_ENABLED", False)
+    # One token per character plus 4, so every turn below costs 20 tokens of a 100 token budget
+    monkeypatch.setattr(main, "CHARS_PER_TOKEN", 1.0)
+    monkeypatch.setattr(main, "HISTORY_TOKEN_BUDGET", 100)
+    monkeypatch.setattr(main, "HISTORY_TOKEN_BUDGETS", {})
+    monkeypatch.setattr(main, "HISTORY_WINDOW_TARGET", 0.5)
+    return fake
+
+
+def conversation(turns: int) -> list[dict]:
+    return [{"role": "user" if n % 2 == 0 else "assistant", "content": f"turn {n:02d} " + "x" * 8,
+             "timestamp": main.next_timestamp().isoformat()} for n in range(turns)]
+
+
+def tokens(history: list[dict]) -> int:
+    return sum(main.estimate_tokens(turn["content"]) for turn in history)
+
+
+async def background_done():
+    await asyncio.gather(*main.background_tasks)
+
+
+def test_budget_uses_the_longest_matching_model_prefix(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_TOKEN_BUDGETS", {"claude-haiku": 3000, "claude-haiku-4-5": 2000})
+    assert main.history_token_budget("claude-haiku-4-5-20251001") == 2000
+    assert main.history_token_budget("claude-haiku-3") == 3000
+    assert main.history_token_budget("claude-sonnet-4-5-20250929") == main.HISTORY_TOKEN_BUDGET
+
+
+def test_window_fits_the_budget_and_starts_on_a_user_turn(summarizer):
+    history = conversation(10)
+    # 5 turns fit in 100 tokens, but the 5th from the end is an assistant reply
+    assert main._fit_window(history, 100) == 6
+    assert main._fit_window(history, 1000) == 0
+    assert main._fit_window(history, 10) == 10
+
+
+def test_history_within_the_budget_is_sent_whole(summarizer):
+    history = conversation(4)
+    summary, window = asyncio.run(main.select_history_window(f"short-{uuid.uuid4().hex}", "claude-test", history))
+    assert (summary, window) == ("", history)
+    assert summarizer.requests == []
+
+
+def test_overflow_folds_down_to_the_target_share_of_the_budget(summarizer):
+    session_id = f"fold-{uuid.uuid4().hex}"
+    history = conversation(10)
+
+    async def scenario():
+        first = await main.select_history_window(session_id, "claude-test", history)
+        await background_done()
+        return first, await main.select_history_window(session_id, "claude-test", history)
+
+    (summary, window), (next_summary, next_window) = asyncio.run(scenario())
+    # Until the summary lands the window is only trimmed to the budget
+    assert summary == "" and window == history[6:]
+
+    [request] = summarizer.requests
+    assert request["model"] == main.SUMMARY_MODEL and request["max_tokens"] == main.SUMMARY_MAX_TOKENS
+    transcript = request["messages"][0]["content"]
+    assert "turn 07" in transcript and "turn 08" not in transcript
+
+    entry = asyncio.run(main.load_session_summary(session_id))
+    assert entry["summarized_through"] == history[7]["timestamp"] and entry["turns_summarized"] == 8
+    # Folded down to half the budget, so the window has room to grow before the next fold
+    assert next_summary == "Resumen: hola" and next_window == history[8:]
+    assert tokens(next_window) <= 50
+
+
+def test_window_is_trimmed_while_the_summary_is_pending(summarizer):
+    session_id = f"pending-{uuid.uuid4().hex}"
+    history = conversation(10)
+    trimmed = main.summary_stats["windows_trimmed"]
+
+    async def scenario():
+        summarizer.hold = asyncio.Event()
+        await main.select_history_window(session_id, "claude-test", history)
+        await asyncio.sleep(0)
+        assert session_id in main.summaries_in_progress
+        longer = history + conversation(4)
+        summary, window = await main.select_history_window(session_id, "claude-test", longer)
+        summarizer.hold.set()
+        await background_done()
+        return longer, summary, window
+
+    longer, summary, window = asyncio.run(scenario())
+    assert summary == "" and window == longer[-4:]
+    assert tokens(window) <= 100 and window[0]["role"] == "user"
+    assert len(summarizer.requests) == 1
+    assert main.summary_stats["windows_trimmed"] == trimmed + 2
+    assert session_id not in main.summaries_in_progress
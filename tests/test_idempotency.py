@@ -0,0 +1,77 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+import pytest
+
+import main
+
+
+def stream_events(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        name, data = block.split("\n", 1)
+        events.append((name.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+async def stored_rows(session_id: str) -> list[dict]:
+    return await main.run_db(main.get_storage().select_history, session_id, 100)
+
+
+async def started(key: tuple[str, str]):
+    """Wait until the first request's turn is running, so the second one is a true in-flight duplicate"""
+    for _ in range(100):
+        if key in main.inflight_requests:
+            return
+        await asyncio.sleep(0.01)
+
+
+def run_with_app(scenario):
+    async def run():
+        async with main.lifespan(main.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+                result = await scenario(client)
+        return result
+    return asyncio.run(run())
+
+
+def test_concurrent_streams_with_one_key_make_one_claude_call(anthropic):
+    session_id = f"stream-{uuid.uuid4().hex}"
+    body = {"query": "hola", "session_id": session_id, "idempotency_key": "k1"}
+
+    async def scenario(client):
+        first = asyncio.create_task(client.post("/chat/stream", json=body))
+        await started((session_id, "k1"))
+        second = await client.post("/chat/stream", json=body)
+        return await first, second
+
+    first, second = run_with_app(scenario)
+    assert len(anthropic.requests) == 1
+    assert first.text == second.text
+    name, data = stream_events(second.text)[-1]
+    assert (name, data["response"]) == ("done", "Hola Paty")
+    assert len(asyncio.run(stored_rows(session_id))) == 2
+    assert (session_id, "k1") not in main.inflight_streams
+
+
+@pytest.mark.parametrize("first_endpoint", ["/chat", "/chat/stream"])
+def test_chat_and_stream_with_one_key_make_one_claude_call(anthropic, first_endpoint):
+    session_id = f"mixed-{uuid.uuid4().hex}"
+    body = {"query": "hola", "session_id": session_id, "idempotency_key": "k2"}
+    second_endpoint = "/chat/stream" if first_endpoint == "/chat" else "/chat"
+
+    async def scenario(client):
+        first = asyncio.create_task(client.post(first_endpoint, json=body))
+        await started((session_id, "k2"))
+        second = await client.post(second_endpoint, json=body)
+        return {first_endpoint: await first, second_endpoint: second}
+
+    responses = run_with_app(scenario)
+    assert len(anthropic.requests) == 1
+    assert responses["/chat"].status_code == 200
+    response = responses["/chat"].json()["response"]
+    name, data = stream_events(responses["/chat/stream"].text)[-1]
+    assert (name, data["response"]) == ("done", response)
+    assert len(asyncio.run(stored_rows(session_id))) == 2
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def store(tmp_path) -> main.JobStore:
+    return main.JobStore(str(tmp_path / "jobs.db"))
+
+
+def test_pending_callback_stays_with_the_finishing_worker(store):
+    store.submit("job-1", "{}", "https://hooks.example.com/amaru", None, 10)
+    job = store.claim("worker-a", 60, 3)
+    assert job["kind"] == "run"
+
+    store.finish("job-1", "succeeded", '{"response": "hola"}', None, 60)
+    # worker-a is delivering the callback inline; nobody else may send it too
+    assert store.claim("worker-b", 60, 3) is None
+
+    # Only if worker-a's lease runs out does another worker take the callback over
+    store.finish("job-1", "succeeded", '{"response": "hola"}', None, -1)
+    job = store.claim("worker-b", 60, 3)
+    assert job["kind"] == "callback" and job["id"] == "job-1"
+
+
+def test_finished_job_without_callback_is_released(store):
+    store.submit("job-2", "{}", None, None, 10)
+    store.claim("worker-a", 60, 3)
+    store.finish("job-2", "succeeded", "{}", None, 60)
+    row = store.connection().execute("SELECT owner, lease_expires FROM jobs WHERE id = 'job-2'").fetchone()
+    assert (row["owner"], row["lease_expires"]) == (None, None)
+
+
+def test_a_job_whose_worker_keeps_dying_fails_after_max_attempts(store):
+    store.submit("job-3", "{}", "https://hooks.example.com/amaru", None, 10)
+    assert store.queued == 1
+    for attempt in (1, 2):
+        # A zero lease expires at once, as if the worker died mid-turn
+        job = store.claim(f"worker-{attempt}", 0, 2)
+        assert (job["kind"], job["attempts"], job["recovered"]) == ("run", attempt, attempt > 1)
+    assert store.queued == 0
+
+    job = store.claim("worker-c", 60, 2)
+    assert job["kind"] == "abandoned" and job["callback_url"] == "https://hooks.example.com/amaru"
+    assert store.get("job-3")["status"] == "failed" and store.get("job-3")["attempts"] == 2
+    # The failed job's callback is leased to worker-c, which delivers it next
+    assert store.claim("worker-d", 60, 2) is None
+
+
+def test_abandoned_job_fails_and_runs_its_callback(monkeypatch, store):
+    store.submit("job-4", "{}", "https://hooks.example.com/amaru", None, 10)
+    store.connection().execute("UPDATE jobs SET status = 'running', attempts = ?, lease_expires = 0",
+                               (main.JOB_MAX_ATTEMPTS,))
+    delivered = []
+
+    async def deliver(job_id, url, attempts):
+        delivered.append((job_id, store.get(job_id)["status"]))
+        main.jobs_stopping = True
+
+    monkeypatch.setattr(main, "job_store", store)
+    monkeypatch.setattr(main, "job_wakeup", asyncio.Event())
+    monkeypatch.setattr(main, "job_executor", None)
+    monkeypatch.setattr(main, "jobs_stopping", False)
+    monkeypatch.setattr(main, "deliver_callback", deliver)
+    failed = main.job_stats["failed"]
+    asyncio.run(main.job_worker(1))
+    main.job_executor.shutdown()
+    assert delivered == [("job-4", "failed")] and main.job_stats["failed"] == failed + 1
+
+
+@pytest.mark.parametrize("hosts, url, allowed", [
+    (set(), "https://hooks.example.com/amaru", False),
+    ({"hooks.example.com"}, "https://hooks.example.com/amaru", True),
+    ({"hooks.example.com"}, "https://other.example.com/amaru", False),
+    ({"*"}, "http://8.8.8.8/amaru", True),
+    ({"*"}, "http://127.0.0.1:8000/admin/prompt/reload", False),
+    ({"*"}, "http://169.254.169.254/latest/meta-data/", False),
+    ({"*"}, "http://10.0.0.7/hook", False),
+    ({"*"}, "http://[::1]/hook", False),
+    ({"*"}, "file:///etc/passwd", False),
+])
+def test_callback_urls_are_denied_unless_allowed(monkeypatch, hosts, url, allowed):
+    monkeypatch.setattr(main, "JOB_CALLBACK_HOSTS", hosts)
+    problem = asyncio.run(main.check_callback_url(url))
+    assert (problem is None) == allowed, problem
@@ -0,0 +1,115 @@
+import os
+import re
+import sqlite3
+
+import pytest
+
+import main
+import migrate
+
+needs_database = pytest.mark.skipif(not os.getenv("DATABASE_URL"),
+                                    reason="needs DATABASE_URL pointing at a disposable Postgres")
+
+CURSOR = ("plan-check", "2026-01-01T00:00:00")
+SESSIONS = ["plan-check", "plan-check-2"]
+
+
+class RecordingQuery:
+    """Supabase table query stand-in that records the PostgREST calls SupabaseStorage makes"""
+
+    def __init__(self, calls: list):
+        self.calls = calls
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return call
+
+    @property
+    def data(self):
+        return []
+
+
+class RecordingClient:
+    def __init__(self):
+        self.calls = []
+
+    def table(self, name: str) -> RecordingQuery:
+        self.calls.append(("table", (name,), {}))
+        return RecordingQuery(self.calls)
+
+
+# What each PostgREST call turns into in the SQL of the matching plan check
+SQL_FOR_CALL = {
+    "eq": lambda column, value: f"{column} = %s",
+    "lt": lambda column, value: f'"{column}" < %s',
+    "gte": lambda column, value: f"{column} >= %s",
+    "in_": lambda column, values: f"{column} IN ({', '.join(['%s'] * len(values))})",
+    "or_": lambda expression: migrate.EXPORT_AFTER,
+}
+
+STORAGE_CALLS = {
+    "history": lambda store: store.select_history("plan-check", 100),
+    "history_page": lambda store: store.select_history("plan-check", 100, CURSOR[1]),
+    "export_start": lambda store: store.export_turns(None, 500),
+    "export_page": lambda store: store.export_turns(CURSOR, 500),
+    "export_sessions": lambda store: store.export_turns(None, 500, SESSIONS),
+    "export_sessions_page": lambda store: store.export_turns(CURSOR, 500, SESSIONS),
+}
+
+
+def test_every_plan_check_mirrors_a_storage_query():
+    assert set(migrate.PLAN_CHECKS) == set(STORAGE_CALLS)
+
+
+@pytest.mark.parametrize("name", sorted(migrate.PLAN_CHECKS))
+def test_plan_check_sql_matches_what_supabase_storage_sends(monkeypatch, name):
+    sql, params, bounded, sorted_ok = migrate.PLAN_CHECKS[name]
+    client = RecordingClient()
+    monkeypatch.setattr(main, "supabase", client)
+    STORAGE_CALLS[name](main.SupabaseStorage())
+
+    calls = {call: args for call, args, _ in client.calls}
+    assert calls["table"] == (main.CONVERSATIONS_TABLE,)
+    columns = main.HISTORY_COLUMNS if name.startswith("history") else main.EXPORT_COLUMNS
+    assert calls["select"] == (columns,)
+    assert sql.startswith(f"SELECT {migrate.select_list(columns)} FROM {main.CONVERSATIONS_TABLE} ")
+    for call, args, _ in client.calls:
+        if call in SQL_FOR_CALL:
+            assert SQL_FOR_CALL[call](*args) in sql, f"{call}{args} has no counterpart in {sql}"
+    orders = [(args[0], kwargs.get("desc", False)) for call, args, kwargs in client.calls if call == "order"]
+    order = ", ".join(('"timestamp"' if column == "timestamp" else column) + (" DESC" if desc else "")
+                      for column, desc in orders)
+    assert f" ORDER BY {order} LIMIT " in sql
+    assert ("WHERE" in sql) == bounded
+    assert sorted_ok == ("IN (" in sql)
+    assert sql.count("%s") == len(params)
+
+
+@pytest.mark.parametrize("name", sorted(migrate.PLAN_CHECKS))
+def test_plan_check_sql_runs_against_the_schema(name):
+    """Each query is valid SQL over the table's real columns (SQLite accepts this subset unchanged)"""
+    sql, params, _, _ = migrate.PLAN_CHECKS[name]
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(main.SQLiteStorage.SCHEMA)
+    cursor = conn.execute(sql.replace("%s", "?"), params)
+    columns = main.HISTORY_COLUMNS if name.startswith("history") else main.EXPORT_COLUMNS
+    assert [column[0] for column in cursor.description] == columns.split(",")
+    assert re.search(r"LIMIT \d+$", sql)
+
+
+@needs_database
+def test_migrations_apply_cleanly():
+    pytest.importorskip("psycopg")
+    with migrate.connect() as conn:
+        assert migrate.apply(conn) == 0
+        assert migrate.status(conn) == 0
+
+
+@needs_database
+def test_history_index_serves_every_storage_query():
+    pytest.importorskip("psycopg")
+    with migrate.connect() as conn:
+        assert migrate.apply(conn) == 0
+        assert migrate.check(conn) == 0
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+
+import main
+from test_idempotency import run_with_app
+
+
+def spin(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_samples_are_folded_into_collapsed_stacks(monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_INTERVAL_MS", 1.0)
+    stop = threading.Event()
+    worker = threading.Thread(target=spin, args=(stop,))
+    worker.start()
+    try:
+        profiler = main.SamplingProfiler(worker.ident, 0.2)
+        profiler.start()
+        profiler.thread.join()
+    finally:
+        stop.set()
+        worker.join()
+
+    lines = profiler.folded().splitlines()
+    assert lines and profiler.samples == sum(int(line.rsplit(" ", 1)[1]) for line in lines)
+    # Root first, leaf last, one label per frame
+    stacks = [line.rsplit(" ", 1)[0].split(";") for line in lines]
+    assert all(stack[0].startswith("_bootstrap (threading.py:") for stack in stacks)
+    assert any(stack[-1].startswith("spin (test_profiling.py:") for stack in stacks)
+
+
+def test_folded_output_is_sorted_one_stack_per_line():
+    profiler = main.SamplingProfiler(threading.get_ident(), 0)
+    profiler.counts = {"main;b": 2, "(idle)": 7, "main;a": 1}
+    assert profiler.folded() == "(idle) 7\nmain;a 1\nmain;b 2\n"
+
+
+def test_a_second_profile_is_rejected_while_one_runs(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    headers = {"Authorization": "Bearer secret"}
+
+    async def scenario(client):
+        first = asyncio.create_task(client.post("/admin/profile", params={"seconds": 0.3}, headers=headers))
+        while main.active_profiler is None:
+            await asyncio.sleep(0.01)
+        second = await client.post("/admin/profile", params={"seconds": 0.3}, headers=headers)
+        return await first, second
+
+    started = time.monotonic()
+    first, second = run_with_app(scenario)
+    assert second.status_code == 409 and second.json()["detail"] == "A profile is already running"
+    assert first.status_code == 200 and first.headers["content-type"].startswith("text/plain")
+    assert int(first.headers["X-Profile-Samples"]) > 0 and time.monotonic() - started >= 0.3
+    # The loop spent the profile waiting on I/O, which folds into the idle stack
+    assert "(idle)" in first.text
+    assert main.active_profiler is None
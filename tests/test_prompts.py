@@ -0,0 +1,34 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def prompt_dir(monkeypatch, tmp_path):
+    for version in ("1.0.0", "1.2.0", "1.10.0"):
+        (tmp_path / f"constitutional-{version}.md").write_text(f"prompt {version}\n")
+    monkeypatch.setattr(main, "PROMPT_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "PROMPT_NAME", "constitutional")
+    monkeypatch.setattr(main, "PROMPT_VERSION", "")
+    monkeypatch.setattr(main, "prompt_pin", "")
+    monkeypatch.setattr(main, "active_prompt", None)
+    return tmp_path
+
+
+def test_reload_without_a_version_unpins(prompt_dir):
+    assert main.get_prompt().version == "1.10.0"
+    assert main.reload_prompt("1.0.0").version == "1.0.0"
+    assert main.reload_prompt_quietly() is None and main.get_prompt().version == "1.0.0"
+
+    assert main.reload_prompt().version == "1.10.0"
+    (prompt_dir / "constitutional-1.11.0.md").write_text("prompt 1.11.0\n")
+    assert main.prompt_changed()
+    assert main.reload_prompt().version == "1.11.0"
+
+
+def test_reload_without_a_version_returns_to_the_configured_one(monkeypatch, prompt_dir):
+    monkeypatch.setattr(main, "PROMPT_VERSION", "1.2.0")
+    monkeypatch.setattr(main, "prompt_pin", "1.2.0")
+    assert main.get_prompt().version == "1.2.0"
+    assert main.reload_prompt("1.10.0").version == "1.10.0"
+    assert main.reload_prompt().version == "1.2.0"
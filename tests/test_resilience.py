@@ -0,0 +1,102 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def model(monkeypatch) -> str:
+    monkeypatch.setattr(main, "CLAUDE_MAX_RETRIES", 2)
+    monkeypatch.setattr(main, "retry_delay", lambda attempt, response=None: 0)
+    monkeypatch.setattr(main, "HEDGE_ENABLED", False)
+    name = "resilience-test-model"
+    main.circuit_breakers.pop(name, None)
+    yield name
+    main.circuit_breakers.pop(name, None)
+
+
+def open_circuit(model: str):
+    main.circuit_breakers[model] = {"failures": main.CIRCUIT_FAILURE_THRESHOLD,
+                                    "opened_at": main.time.monotonic() - main.CIRCUIT_RESET_SECONDS, "probing": False}
+
+
+def test_cancelled_probe_does_not_leave_the_circuit_stuck(monkeypatch, model):
+    async def hang(payload, stream=False):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(main, "_send_claude", hang)
+    open_circuit(model)
+
+    async def cancel_probe():
+        probe = asyncio.create_task(main.request_claude_model(model, {}))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(cancel_probe())
+    state = main.circuit_breakers[model]
+    assert state["probing"] is False and state["opened_at"] is not None
+    # The cancelled probe proved nothing either way, so the next request may probe at once
+    assert state["failures"] == main.CIRCUIT_FAILURE_THRESHOLD
+    assert main.circuit_allows(model)
+
+
+def test_cancelled_attempts_do_not_open_the_circuit(monkeypatch, model):
+    async def hang(payload, stream=False):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(main, "_send_claude", hang)
+
+    async def cancel_attempts():
+        for _ in range(main.CIRCUIT_FAILURE_THRESHOLD * 2):
+            attempt = asyncio.create_task(main.request_claude_model(model, {}))
+            await asyncio.sleep(0.01)
+            attempt.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await attempt
+
+    asyncio.run(cancel_attempts())
+    assert model not in main.circuit_breakers
+    assert main.circuit_allows(model)
+
+
+def test_only_retryable_failures_count_against_the_circuit(monkeypatch, model):
+    statuses = iter([400, 503, 503, 503])
+
+    async def send(payload, stream=False):
+        return httpx.Response(next(statuses), json={})
+
+    monkeypatch.setattr(main, "_send_claude", send)
+    with pytest.raises(HTTPException):
+        asyncio.run(main.request_claude_model(model, {}))
+    assert model not in main.circuit_breakers
+
+    with pytest.raises(HTTPException):
+        asyncio.run(main.request_claude_model(model, {}))
+    assert main.circuit_breakers[model]["failures"] == 3
+
+
+def test_pool_timeouts_are_retried_and_counted(monkeypatch, model):
+    calls = []
+
+    async def send(payload, stream=False):
+        calls.append(payload)
+        if len(calls) < 3:
+            raise httpx.PoolTimeout("pool exhausted")
+        return httpx.Response(200, json={})
+
+    monkeypatch.setattr(main, "_send_claude", send)
+    timeouts = main.anthropic_pool_stats["pool_timeouts"]
+    response = asyncio.run(main.request_claude_model(model, {}))
+    assert response.status_code == 200 and len(calls) == 3
+    assert main.anthropic_pool_stats["pool_timeouts"] == timeouts + 2
+
+    calls.clear()
+    monkeypatch.setattr(main, "CLAUDE_MAX_RETRIES", 1)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.request_claude_model(model, {}))
+    assert error.value.status_code == 503 and len(calls) == 2
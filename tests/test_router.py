@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import main
+
+SHORT, STANDARD = main.ROUTER_CLASSES["short"]["models"][0], main.ROUTER_CLASSES["standard"]["models"][0]
+
+
+@pytest.fixture(autouse=True)
+def router(monkeypatch):
+    monkeypatch.setattr(main, "ROUTER_ENABLED", True)
+    monkeypatch.setattr(main, "router_ewma", {})
+    monkeypatch.setattr(main, "circuit_breakers", main.OrderedDict())
+
+
+def route(query: str, stream: bool = False, **fields) -> dict:
+    return main.route_request(main.AgentRequest(query=query, **fields), [], stream=stream)
+
+
+def observe(model: str, seconds: float | None, count: int = main.ROUTER_MIN_SAMPLES, stream: bool = False):
+    for _ in range(count):
+        main.router_observe(model, stream, seconds)
+
+
+def test_queries_are_classified_by_their_shape():
+    features = lambda query, **fields: main.query_features(main.AgentRequest(query=query, **fields), [])
+    assert main.classify_query(features("hola")) == "short"
+    assert main.classify_query(features("¿Cómo preparo la reunión con el abogado del jueves?")) == "standard"
+    assert main.classify_query(features("¿Qué? ¿Cuándo? ¿Dónde?")) == "complex"
+    assert main.classify_query(features("x" * 4 * main.ROUTER_COMPLEX_TOKENS)) == "complex"
+    assert main.classify_query(features("\n".join(["punto"] * 10))) == "complex"
+    # A short query that comes with corpus context is never "short"
+    assert main.classify_query(features("hola", corpus_context="Maria: daughter")) == "standard"
+
+
+def test_the_preferred_model_is_used_until_it_has_enough_samples():
+    observe(SHORT, main.ROUTER_SLA_SECONDS * 2, count=main.ROUTER_MIN_SAMPLES - 1)
+    decision = route("hola")
+    assert (decision["class"], decision["model"], decision["reason"]) == ("short", SHORT, "preferred")
+
+
+def test_a_model_breaching_the_sla_is_skipped():
+    observe(SHORT, main.ROUTER_SLA_SECONDS * 2)
+    decision = route("hola")
+    assert decision["model"] == main.ROUTER_CLASSES["short"]["models"][1] and decision["reason"] == "latency"
+    # Streams are judged on time to open the stream, which this model has not breached
+    assert route("hola", stream=True)["model"] == SHORT
+
+    observe(SHORT, main.ROUTER_STREAM_SLA_SECONDS * 2, stream=True)
+    assert route("hola", stream=True)["reason"] == "latency"
+
+
+def test_a_failing_model_is_skipped():
+    observe(SHORT, None)
+    assert route("hola")["reason"] == "errors"
+
+
+def test_with_every_model_breaching_the_fastest_is_taken():
+    slow, fast = main.ROUTER_CLASSES["short"]["models"]
+    observe(slow, main.ROUTER_SLA_SECONDS * 3)
+    observe(fast, main.ROUTER_SLA_SECONDS * 2)
+    decision = route("hola")
+    assert (decision["model"], decision["reason"]) == (fast, "degraded")
+
+
+def test_max_tokens_is_cut_to_what_finishes_within_the_sla():
+    budget = main.ROUTER_CLASSES["standard"]["max_tokens"]
+    observe(STANDARD, main.ROUTER_SLA_SECONDS)
+    main.router_observe_usage(STANDARD, {"output_tokens": budget // 4})
+    capped = main.router_stats["budget_capped"]
+    assert route("¿Cómo preparo la reunión?")["max_tokens"] == budget // 4
+    assert main.router_stats["budget_capped"] == capped + 1
+
+    # Never below the floor, never for streams and never over a budget the caller pinned
+    main.router_ewma[STANDARD]["output_tokens"] = 1
+    assert route("¿Cómo preparo la reunión?")["max_tokens"] == main.ROUTER_MIN_MAX_TOKENS
+    assert route("¿Cómo preparo la reunión?", stream=True)["max_tokens"] == budget
+    assert route("¿Cómo preparo la reunión?", max_tokens=3000)["max_tokens"] == 3000
+
+
+def test_pinned_models_are_not_tracked(monkeypatch):
+    monkeypatch.setattr(main, "CIRCUIT_MAX_MODELS", 3)
+    for n in range(5):
+        main.router_observe(f"pinned-{n}", False, 1.0)
+        main.router_observe_usage(f"pinned-{n}", {"output_tokens": 10})
+        main.circuit_record(f"pinned-{n}", False)
+    assert main.router_ewma == {}
+    assert list(main.circuit_breakers) == ["pinned-2", "pinned-3", "pinned-4"]
+    assert main.model_label("pinned-4") == "other"
+
+
+def test_stream_usage_reaches_the_router(monkeypatch, anthropic):
+    monkeypatch.setattr(main, "anthropic_client", None)
+    monkeypatch.setattr(main, "HEDGE_ENABLED", False)
+
+    async def scenario():
+        return [text async for text in main.stream_claude(STANDARD, "prompt", [{"role": "user", "content": "hola"}])]
+
+    assert asyncio.run(scenario()) == ["Hola", " Paty"]
+    assert main.router_ewma[STANDARD]["output_tokens"] == 2
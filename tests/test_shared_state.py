@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def shared(monkeypatch, tmp_path) -> main.SharedState:
+    state = main.SharedState(str(tmp_path / "shared.db"))
+    monkeypatch.setattr(main, "shared_state", state)
+    monkeypatch.setattr(main, "shared_state_executor", None)
+    return state
+
+
+def test_session_lease_is_renewed_while_the_turn_runs(monkeypatch, shared):
+    monkeypatch.setattr(main, "SESSION_LEASE_TTL", 0.3)
+
+    async def long_turn():
+        async with main.session_lock("lease-session"):
+            await asyncio.sleep(1.0)
+            # Several TTLs later the lease is still ours, so no other worker can claim it
+            return await main.shared_call(shared.kv_claim, "session", "lease-session", "other-worker", 60)
+
+    assert asyncio.run(long_turn()) is False
+    assert shared.kv_claim("session", "lease-session", "other-worker", 60)
+
+
+def test_waiting_for_a_held_session_gives_up_after_the_timeout(monkeypatch, shared):
+    monkeypatch.setattr(main, "SESSION_LOCK_TIMEOUT", 0.2)
+    assert shared.kv_claim("session", "busy-session", "other-worker", 60)
+
+    async def turn():
+        async with main.session_lock("busy-session"):
+            pass
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(turn())
+    assert error.value.status_code == 503
+
+
+def test_dropped_writes_leave_the_shared_history_cache(monkeypatch, shared):
+    monkeypatch.setattr(main, "WRITE_RETRIES", 1)
+
+    def fail(rows):
+        raise RuntimeError("storage down")
+
+    monkeypatch.setattr(main, "_insert_turns", fail)
+    kept = {"session_id": "drop-session", "role": "user", "content": "stored", "timestamp": main.next_timestamp().isoformat()}
+    dropped = [{"session_id": "drop-session", "role": role, "content": "lost", "timestamp": main.next_timestamp().isoformat()}
+               for role in ("user", "assistant")]
+    shared.history_add("drop-session", [kept], 100, 60, fill=True)
+    shared.history_add("drop-session", dropped, 100, 60)
+
+    asyncio.run(main.write_batch(dropped))
+    warm, turns = shared.history_get("drop-session", 10)
+    assert not warm
+    assert [turn["content"] for turn in turns] == ["stored"]
+
+
+def test_admission_slots_are_renewed_while_the_turn_runs(monkeypatch, shared):
+    monkeypatch.setattr(main, "SESSION_LEASE_TTL", 0.3)
+    monkeypatch.setattr(main, "chat_admission", main.AdmissionLimiter("chat", 1, 4, 5.0))
+
+    async def long_turn():
+        release = await main.admit(main.AgentRequest(query="hola"))
+        await asyncio.sleep(1.0)
+        # Several TTLs later the only chat slot is still ours
+        other = await main.acquire_shared_slot("chat", 1, 0)
+        release()
+        await asyncio.gather(*main.background_tasks)
+        return other, await main.acquire_shared_slot("chat", 1, 0)
+
+    held, freed = asyncio.run(long_turn())
+    assert held is None and freed is not None
+
+
+def test_idempotency_claims_are_per_request_and_renewed(monkeypatch, shared):
+    monkeypatch.setattr(main, "SESSION_LEASE_TTL", 0.3)
+    key, other_key = ("claim-session", "k1"), ("claim-session", "k2")
+
+    async def long_turn():
+        assert await main.claim_shared_request(key) is None
+        assert await main.claim_shared_request(other_key) is None
+        owners = main.shared_request_claims[key][0], main.shared_request_claims[other_key][0]
+        await asyncio.sleep(1.0)
+        # A duplicate on another worker still cannot take the key of the running turn
+        taken = shared.kv_claim("request", "\x1f".join(key), "other-worker", 60)
+        await main.publish_completed_request(key, main.AgentResponse(response="hola"))
+        await main.publish_completed_request(other_key, None)
+        return owners, taken
+
+    (owner, other_owner), taken = asyncio.run(long_turn())
+    assert owner != other_owner and not taken
+    assert main.shared_request_claims == {}
+    assert shared.kv_claim("request", "\x1f".join(key), "other-worker", 60)
+    assert shared.kv_get("response", "\x1f".join(key)) is not None
@@ -0,0 +1,113 @@
+"""Every ConversationStorage backend must behave identically as far as the agent can tell
+
+History order, limits and keyset pages, column set, session isolation, content
+round trips, summary upserts and export order and paging (including session ids
+PostgREST would need quoted), against sqlite and against SupabaseStorage talking
+to bench/fake_supabase.py in-process.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+import main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+
+
+@pytest.fixture(params=["sqlite", "supabase"])
+def store(request, monkeypatch, tmp_path) -> main.ConversationStorage:
+    if request.param == "sqlite":
+        yield main.SQLiteStorage(str(tmp_path / "conformance.db"))
+        return
+    fake_supabase = pytest.importorskip("fake_supabase")
+    supabase = pytest.importorskip("supabase")
+    from starlette.testclient import TestClient
+
+    with TestClient(fake_supabase.create_app(), base_url="http://fake-supabase") as http:
+        options = supabase.ClientOptions(httpx_client=http)
+        monkeypatch.setattr(main, "supabase", supabase.create_client("http://fake-supabase", "conformance", options=options))
+        yield main.SupabaseStorage()
+
+
+@pytest.fixture
+def run() -> str:
+    return f"conf-{uuid.uuid4().hex[:8]}"
+
+
+def make_rows(session_id: str, count: int, user_id: str = "conformance") -> list[dict]:
+    return [{
+        "session_id": session_id,
+        "user_id": user_id,
+        "role": "user" if i % 2 == 0 else "assistant",
+        "content": f"turn {i}",
+        "model_used": "conformance-model",
+        "timestamp": main.next_timestamp().isoformat(),
+    } for i in range(count)]
+
+
+def ts(value: str):
+    return main._timestamp_key(value)
+
+
+def test_history(store, run):
+    session = f"{run}-history"
+    assert store.select_history(session, 10) == [], "unknown session is not empty"
+
+    rows = make_rows(session, 7)
+    store.insert_turns(rows[:3])
+    store.insert_turns(rows[3:])
+    newest = store.select_history(session, 5)
+    assert [row["content"] for row in newest] == [f"turn {i}" for i in range(6, 1, -1)], "not newest-first or limit ignored"
+    assert set(newest[0]) == set(main.HISTORY_COLUMNS.split(",")), f"columns {sorted(newest[0])}"
+    assert all(ts(a["timestamp"]) > ts(b["timestamp"]) for a, b in zip(newest, newest[1:]))
+
+    older = store.select_history(session, 5, before=newest[-1]["timestamp"])
+    assert [row["content"] for row in older] == ["turn 1", "turn 0"], "keyset page before a timestamp"
+    assert store.select_history(session, 5, before=older[-1]["timestamp"]) == []
+
+
+def test_round_trip(store, run):
+    session = f"{run}-content"
+    content = 'Paty: "¿y ahora?" — 🌱\nline two, (parens) and \\backslash\\'
+    row = make_rows(session, 1)[0]
+    row["content"] = content
+    store.insert_turns([row])
+    (stored,) = store.select_history(session, 5)
+    assert stored["content"] == content, "content changed on the way through"
+    assert ts(stored["timestamp"]) == ts(row["timestamp"]), "timestamp changed on the way through"
+
+
+def test_isolation(store, run):
+    store.insert_turns(make_rows(f"{run}-a", 2) + make_rows(f"{run}-b", 3))
+    assert len(store.select_history(f"{run}-a", 10)) == 2
+    assert len(store.select_history(f"{run}-b", 10)) == 3
+
+
+def test_summaries(store, run):
+    session = f"{run}-summary"
+    assert store.select_summary(session) is None
+    through = main.next_timestamp().isoformat()
+    store.upsert_summary({"session_id": session, "summary": "first", "summarized_through": through,
+                          "turns_summarized": 4, "updated_at": through})
+    store.upsert_summary({"session_id": session, "summary": "second", "summarized_through": through,
+                          "turns_summarized": 8, "updated_at": through})
+    summary = store.select_summary(session)
+    assert summary["summary"] == "second" and summary["turns_summarized"] == 8, summary
+    assert ts(summary["summarized_through"]) == ts(through)
+
+
+def test_export(store, run, monkeypatch):
+    # Ids with the characters PostgREST's or=() syntax needs quoted
+    sessions = [f"{run}-x,(1)", f'{run}-x"2', f"{run}-y"]
+    for session in sessions:
+        store.insert_turns(make_rows(session, 3))
+
+    monkeypatch.setattr(main, "storage", store)
+    paged = list(main.iter_conversation_turns(sessions, page_size=2))
+    assert len(paged) == 9, f"{len(paged)} rows exported instead of 9"
+    keys = [(row["session_id"], ts(row["timestamp"])) for row in paged]
+    assert keys == sorted(keys) and len(set(keys)) == 9, "export not ordered by (session_id, timestamp) or repeated rows"
+    assert set(paged[0]) == set(main.EXPORT_COLUMNS.split(",")), f"columns {sorted(paged[0])}"
+    assert {row["session_id"] for row in store.export_turns(None, 100, sessions[2:])} == {sessions[2]}
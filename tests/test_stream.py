@@ -0,0 +1,71 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+
+import main
+from test_idempotency import run_with_app, stored_rows, stream_events
+
+
+async def disconnecting_stream(body: dict) -> list[dict]:
+    """POST /chat/stream and disconnect as soon as the response starts, before any event arrives"""
+    content = json.dumps(body).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/chat/stream", "raw_path": b"/chat/stream",
+        "query_string": b"", "root_path": "", "server": ("test", 80), "client": ("test", 1234),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode())],
+    }
+    response_started = asyncio.Event()
+    requested = False
+    sent = []
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": content, "more_body": False}
+        await response_started.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if message["type"] == "http.response.start":
+            response_started.set()
+
+    await main.app(scope, receive, send)
+    return sent
+
+
+def test_client_disconnect_still_saves_both_turns(anthropic):
+    session_id = f"disconnect-{uuid.uuid4().hex}"
+
+    async def scenario(client):
+        sent = await disconnecting_stream({"query": "hola", "session_id": session_id})
+        for _ in range(100):
+            if len(await stored_rows(session_id)) == 2:
+                break
+            await asyncio.sleep(0.02)
+        return sent, await stored_rows(session_id)
+
+    sent, rows = run_with_app(scenario)
+    received = b"".join(message.get("body", b"") for message in sent if message["type"] == "http.response.body")
+    assert b"event: done" not in received
+    assert sorted((row["role"], row["content"]) for row in rows) == [("assistant", "Hola Paty"), ("user", "hola")]
+
+
+def test_stream_errors_do_not_leak_internal_text(monkeypatch):
+    async def broken_stream(request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            return httpx.Response(200, json={"data": []})
+        return httpx.Response(200, content=b"data: {upstream secret\n\n", headers={"content-type": "text/event-stream"})
+
+    monkeypatch.setattr(main, "create_anthropic_client", lambda: httpx.AsyncClient(
+        base_url=main.ANTHROPIC_URL, transport=httpx.MockTransport(broken_stream)))
+
+    async def scenario(client):
+        response = await client.post("/chat/stream", json={"query": "hola", "session_id": f"error-{uuid.uuid4().hex}"})
+        return stream_events(response.text)
+
+    assert run_with_app(scenario) == [("error", {"status_code": 502, "detail": "Claude API error"})]
@@ -0,0 +1,111 @@
+import asyncio
+from collections import deque
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+TRACE_ID, PARENT_ID = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+
+
+class RecordingExporter(main.SpanExporter):
+    def __init__(self):
+        self.bodies: list[dict] = []
+
+    async def export(self, body: dict):
+        self.bodies.append(body)
+
+
+@pytest.fixture(autouse=True)
+def exporter(monkeypatch) -> RecordingExporter:
+    recording = RecordingExporter()
+    monkeypatch.setattr(main, "trace_exporter", recording)
+    monkeypatch.setattr(main, "trace_buffer", deque())
+    monkeypatch.setattr(main, "trace_stats", dict.fromkeys(main.trace_stats, 0))
+    monkeypatch.setattr(main, "TRACE_SAMPLE_RATE", 1.0)
+    return recording
+
+
+def exported(exporter: RecordingExporter) -> list[dict]:
+    asyncio.run(main.flush_traces())
+    return [span for body in exporter.bodies for span in body["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+
+
+@pytest.mark.parametrize("traceparent, continued", [
+    (f"00-{TRACE_ID}-{PARENT_ID}-01", True),
+    (f"00-{TRACE_ID}-{PARENT_ID}", False),
+    (f"00-{TRACE_ID[:-1]}-{PARENT_ID}-01", False),
+    ("garbage", False),
+    (None, False),
+])
+def test_a_valid_traceparent_is_continued(traceparent, continued):
+    root = main.start_trace("chat", traceparent)
+    assert (root.trace_id == TRACE_ID) == continued
+    assert root.parent_id == (PARENT_ID if continued else None)
+    assert len(root.trace_id) == 32 and len(root.span_id) == 16
+
+
+def test_tracing_off_hands_out_the_noop_span(monkeypatch):
+    monkeypatch.setattr(main, "trace_exporter", None)
+    with main.root_span("chat", f"00-{TRACE_ID}-{PARENT_ID}-01") as root, main.span("child") as child:
+        assert root is child is main.NOOP_SPAN
+    assert not main.trace_buffer
+
+
+def test_spans_are_encoded_as_otlp_json(exporter):
+    with main.root_span("chat", f"00-{TRACE_ID}-{PARENT_ID}-01", {"amaru.session_id": "s1"}) as root:
+        with main.span("claude", {"cached": True, "tokens": 12, "seconds": 0.5}):
+            pass
+
+    asyncio.run(main.flush_traces())
+    [body] = exporter.bodies
+    [resource] = body["resourceSpans"]
+    assert {"key": "service.name", "value": {"stringValue": main.OTEL_SERVICE_NAME}} in resource["resource"]["attributes"]
+    child, parent = resource["scopeSpans"][0]["spans"]
+    assert parent == {
+        "traceId": TRACE_ID, "spanId": root.span_id, "parentSpanId": PARENT_ID, "name": "chat", "kind": 2,
+        "startTimeUnixNano": str(root.start_ns), "endTimeUnixNano": str(root.end_ns),
+        "attributes": [{"key": "amaru.session_id", "value": {"stringValue": "s1"}}], "status": {"code": 1},
+    }
+    assert (child["traceId"], child["parentSpanId"], child["kind"]) == (TRACE_ID, root.span_id, 1)
+    assert child["attributes"] == [
+        {"key": "cached", "value": {"boolValue": True}},
+        {"key": "tokens", "value": {"intValue": "12"}},
+        {"key": "seconds", "value": {"doubleValue": 0.5}},
+    ]
+    assert int(child["startTimeUnixNano"]) <= int(child["endTimeUnixNano"]) <= root.end_ns
+    assert main.trace_stats["exported"] == 1
+
+
+def test_a_failed_span_marks_its_status(exporter):
+    with pytest.raises(HTTPException):
+        with main.root_span("chat"):
+            with main.span("claude"):
+                raise HTTPException(status_code=503, detail="overloaded")
+
+    child, root = exported(exporter)
+    assert child["status"] == root["status"] == {"code": 2, "message": "HTTP 503"}
+
+
+def test_failed_and_slow_traces_are_kept_whatever_the_sample_rate(monkeypatch, exporter):
+    monkeypatch.setattr(main, "TRACE_SAMPLE_RATE", 0.0)
+    with main.root_span("fast"):
+        pass
+    with pytest.raises(ValueError):
+        with main.root_span("failed"):
+            raise ValueError("boom")
+    slow = main.start_trace("slow")
+    slow.end(slow.start_ns + int(main.TRACE_SLOW_SECONDS * 1e9))
+
+    assert [span["name"] for span in exported(exporter)] == ["failed", "slow"]
+    assert main.trace_stats["sampled_out"] == 1 and main.trace_stats["traces"] == 3
+
+
+def test_the_buffer_drops_the_oldest_trace_when_full(monkeypatch, exporter):
+    monkeypatch.setattr(main, "TRACE_BUFFER_MAX", 2)
+    for name in ("first", "second", "third"):
+        with main.root_span(name):
+            pass
+    assert [span["name"] for span in exported(exporter)] == ["second", "third"]
+    assert main.trace_stats["dropped"] == 1
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def inserts(monkeypatch) -> list[list[dict]]:
+    """Every batch handed to storage, in order; each is still written to the sqlite backend"""
+    batches = []
+    insert = main._insert_turns
+
+    def recording_insert(rows):
+        batches.append(list(rows))
+        insert(rows)
+
+    monkeypatch.setattr(main, "_insert_turns", recording_insert)
+    return batches
+
+
+def new_session(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex}"
+
+
+def stored(session_id: str) -> list[tuple[str, str]]:
+    return [(row["role"], row["content"]) for row in reversed(main.get_storage().select_history(session_id, 100))]
+
+
+async def with_writer(scenario):
+    main.start_write_behind()
+    try:
+        return await scenario()
+    finally:
+        await main.stop_write_behind()
+
+
+def test_turns_from_several_sessions_share_one_batch(inserts):
+    sessions = [new_session("batch") for _ in range(3)]
+
+    async def scenario():
+        await asyncio.gather(*(
+            main.save_conversation_turns(session_id, "paty", [("user", "hola"), ("assistant", "hola Paty")])
+            for session_id in sessions
+        ))
+
+    asyncio.run(with_writer(scenario))
+    assert len(inserts) == 1
+    assert {row["session_id"] for row in inserts[0]} == set(sessions)
+    for session_id in sessions:
+        assert stored(session_id) == [("user", "hola"), ("assistant", "hola Paty")]
+
+
+def test_each_session_keeps_its_enqueue_order(inserts):
+    session_id = new_session("order")
+    turns = [("user" if n % 2 == 0 else "assistant", f"turn {n}") for n in range(6)]
+
+    async def scenario():
+        for turn in turns:
+            await main.save_conversation_turn(session_id, "paty", *turn)
+
+    asyncio.run(with_writer(scenario))
+    rows = [row for batch in inserts for row in batch if row["session_id"] == session_id]
+    timestamps = [main._timestamp_key(row["timestamp"]) for row in rows]
+    assert timestamps == sorted(timestamps) and len(set(timestamps)) == len(timestamps)
+    assert stored(session_id) == turns
+
+
+def test_history_loads_include_turns_still_queued(monkeypatch):
+    session_id = new_session("queued")
+    release = threading.Event()
+    insert = main._insert_turns
+
+    def slow_insert(rows):
+        release.wait(5)
+        insert(rows)
+
+    monkeypatch.setattr(main, "_insert_turns", slow_insert)
+
+    async def scenario():
+        await main.save_conversation_turns(session_id, "paty", [("user", "hola"), ("assistant", "hola Paty")])
+        await asyncio.sleep(main.WRITE_BATCH_INTERVAL * 2)
+        loaded = await main.load_conversation_history(session_id, limit=10)
+        release.set()
+        return loaded
+
+    loaded = asyncio.run(with_writer(scenario))
+    assert [(row["role"], row["content"]) for row in loaded] == [("user", "hola"), ("assistant", "hola Paty")]
+    assert stored(session_id) == [("user", "hola"), ("assistant", "hola Paty")]
+    assert session_id not in main.pending_turns
+
+
+def test_failed_batches_are_retried_then_dropped_and_invalidate_the_cache(monkeypatch):
+    session_id = new_session("dropped")
+    attempts = []
+
+    def failing_insert(rows):
+        attempts.append(rows)
+        raise RuntimeError("storage down")
+
+    monkeypatch.setattr(main, "_insert_turns", failing_insert)
+    monkeypatch.setattr(main, "WRITE_RETRIES", 2)
+    main.history_cache_fill(session_id, [{"role": "user", "content": "older", "timestamp": "2026-01-01T00:00:00"}])
+    dropped = main.write_stats["dropped"]
+
+    async def scenario():
+        await main.save_conversation_turns(session_id, "paty", [("user", "hola"), ("assistant", "hola Paty")])
+
+    asyncio.run(with_writer(scenario))
+    assert len(attempts) == 2
+    assert main.write_stats["dropped"] == dropped + 2
+    assert session_id not in main.history_cache
+    assert session_id not in main.pending_turns
+
+
+def test_shutdown_flushes_everything_queued(monkeypatch, inserts):
+    monkeypatch.setattr(main, "WRITE_BATCH_INTERVAL", 30)
+    sessions = [new_session("flush") for _ in range(2)]
+
+    async def scenario():
+        for session_id in sessions:
+            await main.save_conversation_turn(session_id, "paty", "user", "hola")
+        return time.monotonic()
+
+    queued_at = asyncio.run(with_writer(scenario))
+    # Stopping does not wait out the batch interval
+    assert time.monotonic() - queued_at < 5
+    for session_id in sessions:
+        assert stored(session_id) == [("user", "hola")]
@@ -0,0 +1,149 @@
+"""Summarize the traces written by the jsonl trace exporter (TRACE_EXPORTER=jsonl).
+
+Each line of the trace file is an OTLP/JSON export request, so the file can
+also be fed to anything that reads the OpenTelemetry Collector file format.
+
+`slowest` lists the slowest traces with where their time went. `show` prints
+one trace as a span tree with attributes. `stages` gives latency percentiles
+per span name.
+
+    python traces.py slowest --top 20
+    python traces.py slowest --name chat_stream --file /var/log/amaru/traces.jsonl
+    python traces.py show 4bf92f3577b34da6a3ce929d0e0e4736
+    python traces.py stages
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+
+
+def attribute_value(value: dict):
+    for kind in ("stringValue", "boolValue", "doubleValue"):
+        if kind in value:
+            return value[kind]
+    if "intValue" in value:
+        return int(value["intValue"])
+    return value
+
+
+def load_traces(path: str) -> dict[str, list[dict]]:
+    """trace id -> spans, each with start/end in seconds and attributes as a plain dict"""
+    traces: dict[str, list[dict]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource in json.loads(line).get("resourceSpans", []):
+                for scope in resource.get("scopeSpans", []):
+                    for span in scope.get("spans", []):
+                        traces.setdefault(span["traceId"], []).append({
+                            "span_id": span["spanId"],
+                            "parent_id": span.get("parentSpanId"),
+                            "name": span["name"],
+                            "start": int(span["startTimeUnixNano"]) / 1e9,
+                            "end": int(span["endTimeUnixNano"]) / 1e9,
+                            "attributes": {a["key"]: attribute_value(a["value"]) for a in span.get("attributes", [])},
+                            "error": span.get("status", {}).get("message") if span.get("status", {}).get("code") == 2 else None,
+                        })
+    return traces
+
+
+def root_of(spans: list[dict]) -> dict:
+    ids = {span["span_id"] for span in spans}
+    roots = [span for span in spans if span["parent_id"] not in ids]
+    return min(roots, key=lambda span: span["start"])
+
+
+def children_of(spans: list[dict], parent: dict) -> list[dict]:
+    return sorted((span for span in spans if span["parent_id"] == parent["span_id"]), key=lambda span: span["start"])
+
+
+def duration(span: dict) -> float:
+    return span["end"] - span["start"]
+
+
+def format_seconds(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+
+def breakdown(spans: list[dict], root: dict) -> str:
+    parts = []
+    for child in children_of(spans, root):
+        part = f"{child['name']} {format_seconds(duration(child))}"
+        attempts = children_of(spans, child)
+        if child["name"] == "call_claude" and len(attempts) > 1:
+            part += f" ({len(attempts)} attempts)"
+        if child["error"]:
+            part += f" [{child['error']}]"
+        parts.append(part)
+    return ", ".join(parts)
+
+
+def slowest(traces: dict, top: int, name: str = None):
+    rows = []
+    for trace_id, spans in traces.items():
+        root = root_of(spans)
+        if name and root["name"] != name:
+            continue
+        failed = any(span["error"] for span in spans)
+        rows.append((duration(root), trace_id, root, failed, spans))
+    rows.sort(key=lambda row: row[0], reverse=True)
+    print(f"{len(rows)} traces" + (f" named {name}" if name else ""))
+    for seconds, trace_id, root, failed, spans in rows[:top]:
+        status = "ERROR" if failed else "ok"
+        print(f"{format_seconds(seconds):>9}  {trace_id}  {root['name']:<15} {status:<5}  {breakdown(spans, root)}")
+
+
+def show(traces: dict, trace_id: str) -> int:
+    spans = traces.get(trace_id)
+    if spans is None:
+        print(f"trace {trace_id} not found")
+        return 1
+    root = root_of(spans)
+
+    def walk(span: dict, depth: int):
+        offset = span["start"] - root["start"]
+        attributes = " ".join(f"{key}={value}" for key, value in span["attributes"].items())
+        error = f"  ERROR {span['error']}" if span["error"] else ""
+        print(f"+{offset * 1000:>8.1f}ms {format_seconds(duration(span)):>8}  {'  ' * depth}{span['name']}  {attributes}{error}")
+        for child in children_of(spans, span):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    return 0
+
+
+def stages(traces: dict):
+    durations: dict[str, list[float]] = {}
+    for spans in traces.values():
+        for span in spans:
+            durations.setdefault(span["name"], []).append(duration(span))
+    print(f"{'span':<26}{'count':>8}{'p50':>10}{'p95':>10}{'max':>10}")
+    for name, samples in sorted(durations.items(), key=lambda item: -max(item[1])):
+        samples.sort()
+        p95 = samples[max(0, int(len(samples) * 0.95) - 1)]
+        print(f"{name:<26}{len(samples):>8}{format_seconds(statistics.median(samples)):>10}"
+              f"{format_seconds(p95):>10}{format_seconds(samples[-1]):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", default=os.getenv("TRACE_FILE", "traces.jsonl"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    slowest_parser = commands.add_parser("slowest", help="the slowest traces and where their time went")
+    slowest_parser.add_argument("--top", type=int, default=10)
+    slowest_parser.add_argument("--name", help="only traces whose root span has this name, e.g. chat")
+    show_parser = commands.add_parser("show", help="one trace as a span tree")
+    show_parser.add_argument("trace_id")
+    commands.add_parser("stages", help="latency percentiles per span name")
+    args = parser.parse_args()
+
+    loaded = load_traces(args.file)
+    if args.command == "slowest":
+        slowest(loaded, args.top, args.name)
+    elif args.command == "show":
+        sys.exit(show(loaded, args.trace_id))
+    else:
+        stages(loaded)